@@ -0,0 +1,123 @@
+import collections
+import json
+import sys
+import threading
+import time
+
+from scheduling import apply_role
+
+# Printing from a grab loop costs a console write per frame, which at 200 fps is enough to slow the loop down. Instead,
+# the loop only appends a tuple to a deque (atomic in CPython, no lock taken) and a background thread formats, rate limits
+# and writes the records: as JSON lines to a file, and as plain text to the console.
+#
+# info() and warning() records are always written. frame() is for messages that would otherwise be printed for every
+# frame: the first one of an event is written right away, and the rest within each interval are folded into a single
+# record with a count and the fields of the last one.
+
+
+class AcquisitionLog:
+  def __init__(self, path=None, console=True, interval=1.0, max_pending=10000, poll_interval=0.05):
+    self.path = path
+    self.console = console
+    self.interval = interval
+    self.max_pending = max_pending
+    self.poll_interval = poll_interval
+    self.dropped = 0
+
+    self.pending = collections.deque()
+    self.file = open(path, 'a') if path else None
+
+    # event -> [window start, number folded into the window, last record]
+    self.windows = {}
+    self.closing = threading.Event()
+    self.thread = threading.Thread(target=self.run, name='acquisition-log', daemon=True)
+    self.thread.start()
+
+  def log(self, level, event, message='', rate_limited=False, **fields):
+    """Queue a record; message is formatted with fields on the log thread, e.g. 'Frame {counter}' with counter=12."""
+    if len(self.pending) >= self.max_pending:
+      self.dropped += 1
+      return
+
+    self.pending.append((time.time(), level, event, message, rate_limited, fields))
+
+  def info(self, event, message='', **fields):
+    self.log('info', event, message, **fields)
+
+  def warning(self, event, message='', **fields):
+    self.log('warning', event, message, **fields)
+
+  def frame(self, event, message='', **fields):
+    self.log('info', event, message, rate_limited=True, **fields)
+
+  def close(self):
+    self.closing.set()
+    self.thread.join()
+    if self.file:
+      self.file.close()
+
+  def run(self):
+    apply_role('worker')
+    while True:
+      closing = self.closing.wait(self.poll_interval)
+
+      while self.pending:
+        record = self.pending.popleft()
+        if record[4]:
+          self.limit(record)
+        else:
+          self.write(record)
+
+      self.flush_windows(closing)
+      if self.file:
+        self.file.flush()
+
+      if closing:
+        if self.dropped:
+          self.write((time.time(), 'warning', 'log_dropped', '{dropped} log records were dropped', False,
+                      {'dropped': self.dropped}))
+        if self.file:
+          self.file.flush()
+        return
+
+  def limit(self, record):
+    window = self.windows.get(record[2])
+    if window is None:
+      # First occurrence: written straight away, later ones within the interval are counted
+      self.windows[record[2]] = [record[0], 0, None]
+      self.write(record)
+    else:
+      window[1] += 1
+      window[2] = record
+
+  def flush_windows(self, closing):
+    now = time.time()
+    for event, (start, count, last) in list(self.windows.items()):
+      if not closing and now - start < self.interval:
+        continue
+
+      if count:
+        timestamp, level, _, message, _, fields = last
+        self.write((timestamp, level, event, message, True, dict(fields, repeated=count, window_s=now - start)))
+        self.windows[event] = [now, 0, None]
+      else:
+        # Nothing happened for a whole interval, so the next occurrence is written right away again
+        del self.windows[event]
+
+  def write(self, record):
+    timestamp, level, event, message, _, fields = record
+    try:
+      text = message.format(**fields)
+    except (KeyError, IndexError, ValueError):
+      text = message
+
+    if self.file:
+      self.file.write(json.dumps({'time': timestamp, 'level': level, 'event': event, 'message': text, **fields},
+                                 default=str))
+      self.file.write('\n')
+
+    if self.console:
+      if 'repeated' in fields:
+        text += f' (x{fields["repeated"]} in {fields["window_s"]:.1f}s)'
+      stream = sys.stderr if level == 'warning' else sys.stdout
+      print(text, file=stream)
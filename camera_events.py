@@ -0,0 +1,138 @@
+import csv
+import queue
+import threading
+import warnings
+
+import numpy as np
+
+from pypylon import pylon
+from scheduling import apply_role
+
+# Basler cameras report trigger problems as they happen on their event channel. FrameStartOvertrigger means a trigger
+# arrived while the camera couldn't accept one (the Arduino is faster than exposure + readout allow) and the frame was
+# never taken, so it won't show up as a counter gap either. FrameStartWait means the camera is ready for the next
+# trigger, and ExposureEnd marks the end of every exposure. Event timestamps are on the same camera clock as
+# ChunkTimestamp, so each event can be placed between the frames of a segment.
+
+DEFAULT_EVENTS = ('FrameStartOvertrigger', 'FrameStartWait', 'ExposureEnd')
+EVENT_COLUMNS = ['Event', 'Timestamp_ns', 'FrameIndex', 'FrameID']
+
+
+class EventHandler(pylon.CameraEventHandler):
+  """Runs on pylon's event thread: read the event's timestamp and hand it over, nothing else."""
+
+  def __init__(self, monitor, name):
+    super().__init__()
+    self.monitor = monitor
+    self.name = name
+
+  def OnCameraEvent(self, camera, event_id, node):
+    event = self.monitor.events[event_id]
+    timestamp = getattr(camera, f'Event{event}Timestamp').Value
+
+    frame_id = None
+    if event == 'ExposureEnd':
+      frame_id = camera.EventExposureEndFrameID.Value
+
+    self.monitor.queue.put((self.name, event, timestamp, frame_id))
+
+
+class CameraEventMonitor:
+  """Enables camera events and collects them on a background thread, as running counters and per-segment logs.
+
+  Call enable() for every camera before grabbing starts, then collect() when a camera's segment is finished to get (and
+  optionally write out) the events that fall inside it. Setup problems (unsupported events) go to log, an AcquisitionLog,
+  when one is given.
+  """
+
+  def __init__(self, events=DEFAULT_EVENTS, log=None):
+    self.events = list(events)
+    self.log = log
+    self.handlers = []
+    self.counts = {}
+    self.pending = {}
+
+    self.queue = queue.SimpleQueue()
+    self.thread = threading.Thread(target=self.run, name='camera-events', daemon=True)
+
+  def enable(self, camera, name):
+    # Without GrabCameraEvents the instant camera doesn't read the event channel at all
+    camera.GrabCameraEvents = True
+    supported = camera.EventSelector.Symbolics
+
+    handler = EventHandler(self, name)
+    self.handlers.append(handler)
+    self.counts[name] = {event: 0 for event in self.events}
+
+    for event_id, event in enumerate(self.events):
+      if event not in supported:
+        if self.log:
+          self.log.warning('event_unsupported', 'Camera {camera} does not support {event} events', camera=name,
+                           event=event)
+        else:
+          warnings.warn(f'Camera {name} does not support {event} events')
+        continue
+
+      camera.EventSelector.SetValue(event)
+      camera.EventNotification.SetValue("On")
+      camera.RegisterCameraEventHandler(
+        handler, f'Event{event}Timestamp', event_id, pylon.RegistrationMode_Append, pylon.Cleanup_None
+      )
+
+  def start(self):
+    self.thread.start()
+
+  def stop(self):
+    self.queue.put(None)
+    self.thread.join()
+
+  def collect(self, name, metadata, log_path=None):
+    """Return the events of camera name up to its last frame in metadata, as per-event counts.
+
+    Each event gets the index of the last frame exposed before it (-1 if it came before the first one). Events from before
+    the segment are included too, so overtriggers between segments still end up in a log.
+    """
+    timestamps = np.array([row[0] for row in metadata], dtype=np.int64)
+
+    # The split happens on the monitor thread, which is the only one touching the pending events
+    reply = queue.SimpleQueue()
+    self.queue.put(('collect', name, timestamps[-1] if len(timestamps) else None, reply))
+    events = reply.get()
+
+    rows = [
+      (event, timestamp, int(np.searchsorted(timestamps, timestamp, side='right')) - 1, frame_id)
+      for event, timestamp, frame_id in sorted(events, key=lambda event: event[1])
+    ]
+
+    if log_path:
+      with open(log_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(EVENT_COLUMNS)
+        writer.writerows(rows)
+
+    counts = {event: 0 for event in self.events}
+    for row in rows:
+      counts[row[0]] += 1
+
+    return counts
+
+  def run(self):
+    apply_role('worker')
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+
+      if item[0] == 'collect':
+        _, name, end, reply = item
+        events = self.pending.pop(name, [])
+        if end is not None:
+          # Events that arrived after the segment's last frame belong to the next one
+          self.pending[name] = [event for event in events if event[1] > end]
+          events = [event for event in events if event[1] <= end]
+        reply.put(events)
+        continue
+
+      name, event, timestamp, frame_id = item
+      self.counts[name][event] += 1
+      self.pending.setdefault(name, []).append((event, timestamp, frame_id))
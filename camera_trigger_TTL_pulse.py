@@ -15,12 +15,19 @@ import cv2
 import os
 import time
 import pandas as pd
+from acquisition_log import AcquisitionLog
+from rig_config import load_rig, apply_plan, compile_plan
+from devices import create_device, load_device_map, merge_device_maps
 
 
 ##### function to start and stop grabbing images with a TTL pulse #####
-def grab_during_ttl(cam, converter, video_writer, metadata_list, trigger_line_bit=3):
+def grab_during_ttl(cam, converter, video_writer, metadata_list, trigger_line_bit=3, log=None):
     cam.StartGrabbing(pylon.GrabStrategy_OneByOne, pylon.GrabLoop_ProvidedByUser) # Starts a steady stream of images, provides 1 frame at a time when triggered 
-    print("Waiting for TTL HIGH to begin recording...")
+    # Without a log from the caller, use a console-only one for this call
+    owns_log = log is None
+    if owns_log:
+        log = AcquisitionLog()
+    log.info("waiting", "Waiting for TTL HIGH to begin recording...")
 
     grabbing = False # Do not start recording the images yet- no TTL pulse yet.
 
@@ -31,42 +38,47 @@ def grab_during_ttl(cam, converter, video_writer, metadata_list, trigger_line_bi
                     continue #go on to the next line
 
                 # Read chunk data
-                timestamp = grab.ChunkTimestamp
+                timestamp = grab.ChunkTimestamp.Value
                 line_status = grab.ChunkLineStatusAll.Value
                 counter_val = grab.ChunkCounterValue.Value
                 ttl_state = (line_status >> trigger_line_bit) & 1
 
                 if ttl_state and not grabbing:
-                    print("TTL HIGH detected. Starting frame capture.")
+                    log.info("ttl_high", "TTL HIGH detected. Starting frame capture.", timestamp=timestamp)
                     grabbing = True
 
                 if grabbing:
                     frame = converter.Convert(grab).GetArray()
                     video_writer.write(frame)
                     metadata_list.append((timestamp, line_status, counter_val))
-                    print(f"Grabbed frame at timestamp {timestamp}, TTL state: {ttl_state}") 
+                    # Logged for every frame, but written at most once a second with a count of the rest
+                    log.frame("frame_grabbed", "Grabbed frame at timestamp {timestamp}, TTL state: {ttl_state}",
+                              timestamp=timestamp, ttl_state=ttl_state, counter=counter_val)
 
                     if not ttl_state:
-                        print("TTL LOW detected. Stopping capture.")
+                        log.info("ttl_low", "TTL LOW detected. Stopping capture.", timestamp=timestamp)
                         break  # Stop when TTL falls
         except genicam.TimeoutException:
-            print("No frame received — probably no trigger")
+            log.info("no_frame", "No frame received — probably no trigger")
     cam.StopGrabbing()
+    if owns_log:
+        log.close()
 
 
 ##### Load, rest if needed, and open the camera ####
 
 # Discover and connect to camera
 tlf = pylon.TlFactory.GetInstance() #discover and connect to cameras  
-cam = pylon.InstantCamera(tlf.CreateFirstDevice()) #creates device on the computer for the first camera identified 
+rig = load_rig()
+# camA is opened by its serial number from the rig file (or the device map) so its settings go to the right camera;
+# without one, the first camera found is used
+device_map = merge_device_maps(load_device_map(), rig.device_map())
+if "camA" in device_map:
+    cam = pylon.InstantCamera(create_device(tlf, "camA", device_map))
+else:
+    cam = pylon.InstantCamera(tlf.CreateFirstDevice()) #creates device on the computer for the first camera identified 
 cam.Open() #Opens communication with the camera 
 
-# Load the default camera configuration 
-cam.UserSetSelector.Value = "Default"
-cam.UserSetLoad.Execute()
-# cam.UserSetSave.Execute() # Use to define and save your own settings 
-
-
 ##### Set configurations for cameras ##### 
 
 # Select recording settings
@@ -75,40 +87,22 @@ os.makedirs(camera_dir, exist_ok=True)
 filename = f"camA_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.avi"
 video_path = os.path.join(camera_dir, filename)
 
-# Set the chunks you want (metadata). Here we want to sample IO lines on each framestart trigger 
-#print(cam.ChunkSelector.Symbolics) #lists other metadata you can collect with chunks 
-chunks = ["LineStatusAll", "Timestamp", "CounterValue"]
-cam.ChunkModeActive.SetValue(True) #attach metadata to each image 
-for chunk in chunks:
-    cam.ChunkSelector.SetValue(chunk) #metadata about IO line status for each image (state of TTL pulse)
-    if chunk == "CounterValue": 
-     cam.CounterSelector.SetValue("Counter1")
-     cam.CounterEventSource.SetValue("FrameStart")
-    cam.ChunkEnable.SetValue(True) #activates chunk you are interested in (LineStatus)
-# Confirm chunk is enabled
-    is_enabled = cam.ChunkEnable.GetValue()
-    print(f"Chunk '{chunk}': {'ENABLED' if is_enabled else 'disabled'}")
-#metadata = [] #use to save metadata values 
-
-# Set image quality and format settings 
-cam.Height.SetValue(600)
-cam.Width.SetValue(800)
-cam.ExposureTime.SetValue(3000)
-cam.AcquisitionFrameRateEnable.SetValue(True)
-cam.AcquisitionFrameRate.SetValue(200)
-cam.GainAuto.SetValue("Continuous")
-
-# Setup the trigger/acquisition controls 
-cam.TriggerSelector.SetValue("FrameStart")
-cam.TriggerActivation.SetValue("RisingEdge")
-cam.TriggerSource.SetValue("Line3")
-cam.TriggerMode.SetValue("On")
+# Chunks (IO line status, timestamp and FrameStart counter on every frame), ROI, exposure and trigger, as described for
+# camA in the rig file (rig_config.py). Only the nodes that differ from what the camera already has are written, so there
+# is no UserSetLoad and full rewrite on every start
+configuration = apply_plan(cam, compile_plan(rig.settings("camA")))
+print(f"Configured camA: {configuration.summary()}")
+for node, selectors, expected, actual in configuration.mismatches:
+    print(f"Tried to set {node} to {expected} ({dict(selectors)}), but it reads {actual}")
 
 # Create an image format converter
 converter = pylon.ImageFormatConverter()
 converter.OutputPixelFormat = pylon.PixelType_BGR8packed  # For OpenCV (color)
 converter.OutputBitAlignment = pylon.OutputBitAlignment_MsbAligned
 
+# Diagnostics go to a JSON lines log next to the videos, written on a background thread
+log = AcquisitionLog(os.path.join(camera_dir, "acquisition.jsonl"))
+
 try:
     while True:
         timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
@@ -123,7 +117,7 @@ try:
         )
 
         metadata = []
-        grab_during_ttl(cam, converter, video_writer, metadata)
+        grab_during_ttl(cam, converter, video_writer, metadata, log=log)
 
         # Save metadata
         metadata_filename = f"metadata_{timestamp}.csv"
@@ -133,7 +127,8 @@ try:
 
         video_writer.release()
 except KeyboardInterrupt:
-    print("Recording stopped by user.")
+    log.info("stopped", "Recording stopped by user.")
 finally:
+    log.close()
     cam.Close()
     cv2.destroyAllWindows()
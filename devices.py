@@ -0,0 +1,69 @@
+import json
+import os
+
+# Camera names are mapped to serial numbers once (`pylon-recorder devices --assign camA=<serial> ...`) and stored here.
+# Opening a camera by serial then skips the full EnumerateDevices scan over every transport layer, and a camera keeps its
+# name no matter which order the USB bus reports the devices in.
+DEFAULT_DEVICE_MAP = os.path.join(os.path.expanduser('~'), '.pylon_recorder', 'devices.json')
+
+
+def load_device_map(path=DEFAULT_DEVICE_MAP):
+  if not os.path.exists(path):
+    return {}
+
+  with open(path) as f:
+    return json.load(f)
+
+
+def save_device_map(device_map, path=DEFAULT_DEVICE_MAP):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'w') as f:
+    json.dump(device_map, f, indent=2)
+
+
+def merge_device_maps(device_map, overrides):
+  """device_map with overrides' entries merged in name by name. A cached device_class is kept as long as the serial
+  number stays the same."""
+  merged = {name: dict(entry) for name, entry in (device_map or {}).items()}
+  for name, entry in overrides.items():
+    if merged.get(name, {}).get('serial') == entry.get('serial'):
+      merged[name].update(entry)
+    else:
+      merged[name] = dict(entry)
+  return merged
+
+
+def discover_devices():
+  """Enumerate every connected camera. This is the slow path, only needed when (re)building the device map."""
+  from pypylon import pylon
+
+  return [
+    {
+      'serial': device.GetSerialNumber(),
+      'model': device.GetModelName(),
+      'device_class': device.GetDeviceClass(),
+      'user_defined_name': device.GetUserDefinedName()
+    }
+    for device in pylon.TlFactory.GetInstance().EnumerateDevices()
+  ]
+
+
+def create_device(tlf, name, device_map):
+  """Create the pylon device for a named camera straight from its stored serial number."""
+  from pypylon import pylon
+
+  if name not in device_map:
+    raise KeyError(f'No serial number stored for camera {name}; run `pylon-recorder devices --assign {name}=<serial>`')
+
+  entry = device_map[name]
+  info = pylon.DeviceInfo()
+  info.SetSerialNumber(entry['serial'])
+
+  # Restricting the lookup to the camera's transport layer (e.g. BaslerUsb) avoids probing GigE and the others
+  if entry.get('device_class'):
+    info.SetDeviceClass(entry['device_class'])
+
+  try:
+    return tlf.CreateDevice(info)
+  except Exception as e:
+    raise RuntimeError(f'Camera {name} (serial {entry["serial"]}) was not found; is it connected?') from e
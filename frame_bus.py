@@ -0,0 +1,284 @@
+import os
+import time
+import warnings
+
+import numpy as np
+
+from multiprocessing import resource_tracker, shared_memory
+
+# Each camera gets its own shared-memory ring named <prefix>_<camera>. The ring starts with a header describing the
+# frames and the publishing process, followed by fixed size slots. Every slot holds a small metadata record and one
+# frame. Publishers on the same machine need different prefixes (multi_host nodes use their port by default).
+#
+# The acquisition loop is the only writer and never waits for anyone. Slots are protected by a sequence lock: the writer
+# bumps `begin` before touching a slot and sets `end` to the same value once it's done, so a reader that sees
+# begin == end == the sequence it asked for knows the copy it took wasn't overwritten halfway through.
+MAGIC = 0x50594C4E
+
+HEADER_DTYPE = np.dtype([
+  ('magic', '<u4'),
+  ('slots', '<u4'),
+  ('height', '<u4'),
+  ('width', '<u4'),
+  ('channels', '<u4'),
+  ('dtype', 'S8'),
+  ('sequence', '<u8'),
+  ('ndim', '<u4'),
+  ('pid', '<u4'),
+])
+HEADER_SIZE = 64
+
+SLOT_DTYPE = np.dtype([
+  ('begin', '<u8'),
+  ('end', '<u8'),
+  ('timestamp', '<i8'),
+  ('line_status', '<i8'),
+  ('counter', '<i8'),
+  ('published_ns', '<i8'),
+])
+SLOT_HEADER_SIZE = 64
+
+
+def ring_name(prefix, camera):
+  return f'{prefix}_{camera}'
+
+
+def ring_in_use(memory):
+  """Whether an existing block is a ring whose publisher is still running."""
+  # Outside POSIX a block only exists while some process has it open, so an existing one is always in use
+  if os.name != 'posix':
+    return True
+
+  if memory.size < HEADER_DTYPE.itemsize:
+    return False
+
+  header = np.ndarray((), HEADER_DTYPE, memory.buf, 0)
+  magic, pid = int(header['magic']), int(header['pid'])
+  del header
+  if magic != MAGIC or not pid:
+    return False
+
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+
+class Ring:
+  """Typed views over one camera's shared-memory block."""
+
+  def __init__(self, memory):
+    self.memory = memory
+    self.header = np.ndarray((), HEADER_DTYPE, memory.buf, 0)
+
+    self.slots = int(self.header['slots'])
+    # Mono (and unpacked 10/12-bit) frames are published as 2-D arrays and come back that way
+    self.shape = (int(self.header['height']), int(self.header['width']), int(self.header['channels']))
+    if self.header['ndim'] == 2:
+      self.shape = self.shape[:2]
+    self.dtype = np.dtype(self.header['dtype'].item().decode())
+    self.frame_size = int(np.prod(self.shape)) * self.dtype.itemsize
+    self.slot_size = SLOT_HEADER_SIZE + self.frame_size
+
+    self.slot_headers = []
+    self.frames = []
+    for slot in range(self.slots):
+      offset = HEADER_SIZE + slot * self.slot_size
+      self.slot_headers.append(np.ndarray((), SLOT_DTYPE, memory.buf, offset))
+      self.frames.append(np.ndarray(self.shape, self.dtype, memory.buf, offset + SLOT_HEADER_SIZE))
+
+  @staticmethod
+  def create(name, slots, frame):
+    shape = frame.shape if frame.ndim == 3 else frame.shape + (1,)
+    size = HEADER_SIZE + slots * (SLOT_HEADER_SIZE + frame.nbytes)
+    try:
+      memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+    except FileExistsError:
+      # Left behind by a publisher that didn't get to close() is replaced; one that's still publishing is left alone
+      existing = shared_memory.SharedMemory(name=name)
+      in_use = ring_in_use(existing)
+      if in_use and os.name == 'posix':
+        # Attaching registered it with our resource tracker, which would unlink it from under its owner when we exit
+        resource_tracker.unregister(existing._name, 'shared_memory')
+      existing.close()
+      if in_use:
+        raise FileExistsError(f'{name} is in use by another publisher; give this one a different prefix')
+
+      existing.unlink()
+      memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+    header = np.ndarray((), HEADER_DTYPE, memory.buf, 0)
+    header['magic'] = MAGIC
+    header['slots'] = slots
+    header['height'], header['width'], header['channels'] = shape
+    header['dtype'] = frame.dtype.str.encode()
+    header['sequence'] = 0
+    header['ndim'] = frame.ndim
+    header['pid'] = os.getpid()
+
+    return Ring(memory)
+
+  def close(self):
+    # The numpy views hold on to the buffer, so they have to go before the memory can be closed
+    self.header = None
+    self.slot_headers = []
+    self.frames = []
+    self.memory.close()
+
+
+class FrameBus:
+  """Publishing side of the bus, owned by the acquisition loop.
+
+  publish() does one copy of the frame into the next slot and returns; it never waits for subscribers. Rings are created
+  on each camera's first frame, since that's when the frame size is known. A ring that can't be created only stops that
+  camera's frames from being published; it never interrupts the recording.
+  """
+
+  def __init__(self, prefix='pylon', slots=16):
+    self.prefix = prefix
+    self.slots = slots
+    self.rings = {}
+    self.sequences = {}
+    self.unavailable = set()
+
+  def publish(self, camera, frame, metadata):
+    ring = self.rings.get(camera)
+    if ring is None:
+      if camera in self.unavailable:
+        return
+
+      try:
+        ring = self.rings[camera] = Ring.create(ring_name(self.prefix, camera), self.slots, frame)
+      except OSError as e:
+        # e.g. another running publisher with the same prefix
+        self.unavailable.add(camera)
+        warnings.warn(f'Not publishing {camera} frames: {e!r}')
+        return
+      self.sequences[camera] = 0
+
+    sequence = self.sequences[camera] + 1
+    self.sequences[camera] = sequence
+
+    slot = ring.slot_headers[sequence % ring.slots]
+    slot['begin'] = sequence
+    ring.frames[sequence % ring.slots].reshape(frame.shape)[...] = frame
+    slot['timestamp'], slot['line_status'], slot['counter'] = metadata
+    slot['published_ns'] = time.monotonic_ns()
+    slot['end'] = sequence
+
+    ring.header['sequence'] = sequence
+
+  def close(self):
+    for ring in self.rings.values():
+      memory = ring.memory
+      ring.close()
+      memory.unlink()
+
+    self.rings = {}
+
+
+class FrameSubscriber:
+  """Reads one camera's frames from the bus in another process.
+
+  latest() always jumps to the newest frame, which suits closed-loop work where only the current state matters.
+  next() delivers frames in order; when the subscriber falls more than a ring's worth behind, the overwritten frames are
+  skipped and counted in `missed`.
+  """
+
+  def __init__(self, camera, prefix='pylon', timeout=None):
+    name = ring_name(prefix, camera)
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    # The ring only exists once the camera has published its first frame
+    while True:
+      try:
+        memory = shared_memory.SharedMemory(name=name)
+        break
+      except FileNotFoundError:
+        if deadline is not None and time.monotonic() > deadline:
+          raise
+        time.sleep(0.05)
+
+    # Attaching registers the block with this process's resource tracker, which would unlink it when we exit and take
+    # the ring away from the publisher and every other subscriber. There's no tracker outside POSIX
+    if os.name == 'posix':
+      resource_tracker.unregister(memory._name, 'shared_memory')
+
+    self.ring = Ring(memory)
+    if self.ring.header['magic'] != MAGIC:
+      raise ValueError(f'{name} is not a frame bus ring')
+
+    self.sequence = int(self.ring.header['sequence'])
+    self.missed = 0
+
+  def read(self, sequence, copy=True):
+    """Return (frame, metadata) for sequence, or None if it was overwritten while reading.
+
+    With copy=False the frame is a view straight into shared memory; check still_valid() after using it.
+    """
+    slot = self.ring.slot_headers[sequence % self.ring.slots]
+    if slot['end'] != sequence:
+      return None
+
+    frame = self.ring.frames[sequence % self.ring.slots]
+    if copy:
+      frame = frame.copy()
+    metadata = {
+      'sequence': sequence,
+      'timestamp': int(slot['timestamp']),
+      'line_status': int(slot['line_status']),
+      'counter': int(slot['counter']),
+      'published_ns': int(slot['published_ns'])
+    }
+
+    if slot['begin'] != sequence:
+      return None
+
+    return frame, metadata
+
+  def still_valid(self, metadata):
+    return self.ring.slot_headers[metadata['sequence'] % self.ring.slots]['begin'] == metadata['sequence']
+
+  def latest(self, copy=True):
+    """Return the newest frame not seen yet, or None if nothing new was published."""
+    while True:
+      sequence = int(self.ring.header['sequence'])
+      if sequence == self.sequence:
+        return None
+
+      result = self.read(sequence, copy)
+      if result is not None:
+        self.sequence = sequence
+        return result
+
+  def next(self, timeout=None, copy=True):
+    """Return the frame after the last one read, waiting up to timeout seconds. Returns None on timeout."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+      published = int(self.ring.header['sequence'])
+      if published > self.sequence:
+        # Anything older than one ring behind the writer is gone
+        oldest = published - self.ring.slots + 1
+        if self.sequence + 1 < oldest:
+          self.missed += oldest - self.sequence - 1
+          self.sequence = oldest - 1
+
+        result = self.read(self.sequence + 1, copy)
+        if result is not None:
+          self.sequence += 1
+          return result
+
+        # Overwritten while we were copying; count it and move on to the next one
+        self.missed += 1
+        self.sequence += 1
+        continue
+
+      if deadline is not None and time.monotonic() > deadline:
+        return None
+      time.sleep(0.0005)
+
+  def close(self):
+    self.ring.close()
@@ -0,0 +1,123 @@
+import queue
+import threading
+
+import numpy as np
+
+from scheduling import apply_role
+
+QUALITY_COLUMNS = ["MeanBrightness", "SaturatedFraction", "MotionEnergy"]
+
+
+class FrameQualityWorker:
+  """Computes cheap per-frame quality metrics on a background thread.
+
+  The grab loop hands over a strided view of each frame with submit(), which never blocks; if the worker falls behind,
+  frames are skipped and their metrics come back as NaN. Frames are processed in batches so the numpy work is vectorized
+  across many frames at once. Motion energy is the mean absolute difference from the previous frame of the same camera.
+  """
+
+  def __init__(self, downsample=4, batch_size=32, saturation_level=255, max_pending=512):
+    self.downsample = downsample
+    self.batch_size = batch_size
+    self.saturation_level = saturation_level
+    self.dropped = 0
+
+    self.queue = queue.Queue(maxsize=max_pending)
+    self.batches = {}
+    self.previous = {}
+    self.results = {}
+    self.thread = threading.Thread(target=self.run, name='frame-quality', daemon=True)
+
+  def start(self):
+    self.thread.start()
+
+  def stop(self):
+    self.queue.put(None)
+    self.thread.join()
+
+  def submit(self, key, index, frame):
+    # Only the downsampled copy crosses the thread boundary, which keeps this cheap enough for the grab loop
+    small = np.ascontiguousarray(frame[::self.downsample, ::self.downsample])
+    try:
+      self.queue.put_nowait((key, index, small))
+    except queue.Full:
+      self.dropped += 1
+
+  def collect(self, key, frame_count):
+    """Wait for every frame submitted under key and return its metrics as columns of length frame_count."""
+    done = threading.Event()
+    self.queue.put(('collect', key, done))
+    done.wait()
+
+    columns = {name: np.full(frame_count, np.nan) for name in QUALITY_COLUMNS}
+    for indices, brightness, saturated, motion in self.results.pop(key, []):
+      keep = indices < frame_count
+      columns["MeanBrightness"][indices[keep]] = brightness[keep]
+      columns["SaturatedFraction"][indices[keep]] = saturated[keep]
+      columns["MotionEnergy"][indices[keep]] = motion[keep]
+
+    return columns
+
+  def run(self):
+    apply_role('worker')
+    while True:
+      item = self.queue.get()
+      if item is None:
+        for key in list(self.batches):
+          self.process(key)
+        return
+
+      if item[0] == 'collect':
+        _, key, done = item
+        self.process(key)
+
+        # The next segment for this camera starts fresh, so don't difference against the last frame of this one
+        self.previous.pop(key, None)
+        done.set()
+        continue
+
+      key, index, small = item
+      batch = self.batches.setdefault(key, [])
+      batch.append((index, small))
+      if len(batch) >= self.batch_size:
+        self.process(key)
+
+  def process(self, key):
+    batch = self.batches.pop(key, None)
+    if not batch:
+      return
+
+    indices = np.fromiter((index for index, _ in batch), dtype=np.int64, count=len(batch))
+    frames = np.stack([small for _, small in batch])
+
+    # Color frames are averaged down to intensity so mono and BGR output give the same brightness and motion. A pixel is
+    # saturated as soon as any one of its channels is clipped, which the average would hide
+    if frames.ndim == 4:
+      gray = frames.mean(axis=3, dtype=np.float32)
+      peak = frames.max(axis=3)
+    else:
+      gray = frames.astype(np.float32)
+      peak = frames
+
+    brightness = gray.mean(axis=(1, 2))
+    saturated = (peak >= self.saturation_level).mean(axis=(1, 2))
+
+    # Difference against the last frame of the previous batch, unless this is the start of the segment
+    previous = self.previous.get(key)
+    if previous is not None:
+      previous_index, previous_gray = previous
+      indices_with_previous = np.concatenate([[previous_index], indices])
+      gray_with_previous = np.concatenate([previous_gray[None], gray])
+    else:
+      indices_with_previous = np.concatenate([[indices[0] - 1], indices])
+      gray_with_previous = np.concatenate([gray[:1], gray])
+
+    motion = np.abs(np.diff(gray_with_previous, axis=0)).mean(axis=(1, 2))
+
+    # Frames skipped because the queue was full would make a difference span more than one frame
+    motion[np.diff(indices_with_previous) != 1] = np.nan
+    if previous is None:
+      motion[0] = np.nan
+
+    self.previous[key] = (indices[-1], gray[-1])
+    self.results.setdefault(key, []).append((indices, brightness, saturated, motion))
@@ -0,0 +1,264 @@
+import argparse
+import csv
+import json
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from pypylon import genicam, pylon
+from devices import create_device, load_device_map, DEFAULT_DEVICE_MAP
+from segment_writers import SEGMENT_WRITERS
+
+# Measures how long a frame takes from its trigger to each stage of the recording pipeline. Triggers are fired one at a
+# time from the host, so the host knows exactly when each one happened:
+#   software: TriggerSoftware over the control channel (works with pylon camera emulation)
+#   loopback: the camera drives one of its own output lines (UserOutput1), wired back to the trigger input the Arduino
+#             normally uses, so the frame goes through the same hardware trigger path as a beam break
+# Host times are perf_counter_ns. When the camera supports TimestampLatch, its clock is mapped onto the host clock so the
+# ChunkTimestamp (start of exposure) can be placed on the same timeline.
+
+STAGES = ['fired', 'exposure_start', 'retrieved', 'converted', 'written', 'synced']
+FRAME_COLUMNS = ['Trigger', 'ChunkTimestamp'] + [f'{stage}_ns' for stage in ['trigger'] + STAGES]
+
+
+def latch_clock(camera, samples=5):
+  """Return (host_ns, camera_ns) for the latch with the shortest round trip, or None without TimestampLatch."""
+  node = camera.GetNodeMap().GetNode('TimestampLatch')
+  if node is None or not genicam.IsAvailable(node):
+    return None
+
+  best = None
+  for _ in range(samples):
+    before = time.perf_counter_ns()
+    camera.TimestampLatch.Execute()
+    after = time.perf_counter_ns()
+    latched = camera.TimestampLatchValue.Value
+    if best is None or after - before < best[0]:
+      best = (after - before, (before + after) // 2, latched)
+
+  return best[1], best[2]
+
+
+def clock_mapping(start, end):
+  """Turn latches taken before and after a run into a camera -> host conversion, allowing for drift between the clocks.
+
+  Assumes the camera ticks in nanoseconds, as USB3 cameras do.
+  """
+  if start is None or end is None:
+    return None
+
+  (host_start, camera_start), (host_end, camera_end) = start, end
+  rate = (host_end - host_start) / (camera_end - camera_start) if camera_end != camera_start else 1.0
+  return lambda camera_ns: host_start + (camera_ns - camera_start) * rate
+
+
+class LatencyHarness:
+  """Fires triggers at one camera and timestamps every frame through retrieval, conversion, writing and fsync."""
+
+  def __init__(self, camera, emulated=False, timeout_ms=1000):
+    self.camera = camera
+    self.emulated = emulated
+    self.timeout_ms = timeout_ms
+
+    self.converter = pylon.ImageFormatConverter()
+    self.converter.OutputPixelFormat = pylon.PixelType_BGR8packed
+    self.converter.OutputBitAlignment = pylon.OutputBitAlignment_MsbAligned
+
+  def configure(self, trigger, trigger_line, output_line):
+    camera = self.camera
+    camera.UserSetSelector.Value = "Default"
+    camera.UserSetLoad.Execute()
+    camera.Height.SetValue(600)
+    camera.Width.SetValue(800)
+
+    if not self.emulated:
+      camera.ChunkModeActive.SetValue(True)
+      camera.ChunkSelector.SetValue("Timestamp")
+      camera.ChunkEnable.SetValue(True)
+      camera.ExposureTime.SetValue(3000)
+
+    camera.TriggerSelector.SetValue("FrameStart")
+    camera.TriggerMode.SetValue("On")
+    if trigger == 'software':
+      camera.TriggerSource.SetValue("Software")
+    else:
+      camera.LineSelector.SetValue(output_line)
+      camera.LineMode.SetValue("Output")
+      camera.LineSource.SetValue("UserOutput1")
+      camera.UserOutputSelector.SetValue("UserOutput1")
+      camera.UserOutputValue.SetValue(False)
+
+      camera.TriggerActivation.SetValue("RisingEdge")
+      camera.TriggerSource.SetValue(f'Line{trigger_line}')
+
+  def wait_ready(self, trigger):
+    # Not part of the measured latency: the previous frame has to be out of the camera before the next trigger counts
+    if trigger == 'software':
+      self.camera.WaitForFrameTriggerReady(self.timeout_ms, pylon.TimeoutHandling_ThrowException)
+
+  def fire(self, trigger):
+    if trigger == 'software':
+      self.camera.TriggerSoftware.Execute()
+    else:
+      self.camera.UserOutputValue.SetValue(True)
+
+  def rearm(self, trigger):
+    if trigger == 'loopback':
+      self.camera.UserOutputValue.SetValue(False)
+
+  def chunk_timestamp(self, grab):
+    if self.emulated:
+      return grab.GetTimeStamp()
+    return grab.ChunkTimestamp.Value
+
+  def run(self, trigger, segment_writer, frames, directory, sync=False, interval=0.01):
+    """Run one configuration and return one row of host timestamps per trigger (ns, None where a stage didn't happen)."""
+    video_path = os.path.join(directory, f'latency{segment_writer.extension}')
+    writer = segment_writer(video_path, os.path.join(directory, 'latency_metadata'), cv2.VideoWriter_fourcc(*'XVID'),
+                            200.0, (800, 600))
+
+    # Frames are written by the real segment writer; fsync goes through a separate descriptor on the same file
+    sync_fd = os.open(writer.video_path, os.O_RDONLY) if sync else None
+
+    rows = []
+    start_latch = latch_clock(self.camera)
+    self.camera.StartGrabbing(pylon.GrabStrategy_OneByOne)
+    try:
+      for i in range(frames):
+        row = dict.fromkeys(FRAME_COLUMNS)
+        row['Trigger'] = i
+
+        self.wait_ready(trigger)
+        row['trigger_ns'] = time.perf_counter_ns()
+        self.fire(trigger)
+        row['fired_ns'] = time.perf_counter_ns()
+
+        grab = self.camera.RetrieveResult(self.timeout_ms, pylon.TimeoutHandling_Return)
+        row['retrieved_ns'] = time.perf_counter_ns()
+        self.rearm(trigger)
+
+        if grab.IsValid() and grab.GrabSucceeded():
+          frame = self.converter.Convert(grab).GetArray()
+          row['converted_ns'] = time.perf_counter_ns()
+
+          row['ChunkTimestamp'] = self.chunk_timestamp(grab)
+          writer.write(frame, (row['ChunkTimestamp'], 0, i))
+          row['written_ns'] = time.perf_counter_ns()
+
+          if sync:
+            os.fsync(sync_fd)
+            row['synced_ns'] = time.perf_counter_ns()
+        else:
+          # The trigger never produced a frame within the timeout
+          row['retrieved_ns'] = None
+
+        if grab.IsValid():
+          grab.Release()
+        rows.append(row)
+
+        # Let the camera settle so one trigger's frame isn't queued behind the previous one
+        time.sleep(interval)
+    finally:
+      self.camera.StopGrabbing()
+      if sync_fd is not None:
+        os.close(sync_fd)
+      writer.close([(row['ChunkTimestamp'], 0, row['Trigger']) for row in rows if row['written_ns']])
+
+    to_host = clock_mapping(start_latch, latch_clock(self.camera))
+    if to_host:
+      for row in rows:
+        if row['ChunkTimestamp'] is not None:
+          row['exposure_start_ns'] = int(to_host(row['ChunkTimestamp']))
+
+    return rows
+
+
+def summarize(rows):
+  """Latency from the trigger to each stage, in milliseconds, as percentiles over all triggers that got that far."""
+  summary = {'triggers': len(rows), 'frames': sum(row['written_ns'] is not None for row in rows)}
+  for stage in STAGES:
+    latencies = np.array([
+      row[f'{stage}_ns'] - row['trigger_ns'] for row in rows if row[f'{stage}_ns'] is not None
+    ], dtype=np.float64) / 1e6
+    if not len(latencies):
+      continue
+
+    summary[stage] = {
+      'mean_ms': float(latencies.mean()),
+      'p50_ms': float(np.percentile(latencies, 50)),
+      'p90_ms': float(np.percentile(latencies, 90)),
+      'p99_ms': float(np.percentile(latencies, 99)),
+      'max_ms': float(latencies.max()),
+    }
+
+  return summary
+
+
+def write_rows(path, rows):
+  with open(path, 'w', newline='') as f:
+    writer = csv.DictWriter(f, FRAME_COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Measure trigger-to-frame and trigger-to-disk latency')
+  parser.add_argument('--output', required=True, help='Directory for the per-frame logs and the report')
+  parser.add_argument('--triggers', nargs='+', choices=['software', 'loopback'], default=['software'])
+  parser.add_argument('--formats', nargs='+', choices=sorted(SEGMENT_WRITERS), default=['avi'])
+  parser.add_argument('--sync', action='store_true', help='Also measure each configuration with an fsync per frame')
+  parser.add_argument('--frames', type=int, default=500, help='Triggers per configuration')
+  parser.add_argument('--interval', type=float, default=0.01, help='Seconds between triggers')
+  parser.add_argument('--trigger-line', type=int, default=3, help='Input line the loopback is wired to')
+  parser.add_argument('--output-line', default='Line2', help='Output line driven for the loopback trigger')
+  parser.add_argument('--emulate', action='store_true', help='Use pylon camera emulation (software trigger only)')
+  parser.add_argument('--device-map', default=DEFAULT_DEVICE_MAP)
+  args = parser.parse_args()
+
+  if args.emulate:
+    os.environ['PYLON_CAMEMU'] = '1'
+
+  tlf = pylon.TlFactory.GetInstance()
+  device_map = {} if args.emulate else load_device_map(args.device_map)
+  if 'camA' in device_map:
+    camera = pylon.InstantCamera(create_device(tlf, 'camA', device_map))
+  else:
+    camera = pylon.InstantCamera(tlf.CreateFirstDevice())
+  camera.Open()
+
+  os.makedirs(args.output, exist_ok=True)
+  harness = LatencyHarness(camera, emulated=args.emulate)
+  report = {}
+
+  try:
+    for trigger in args.triggers:
+      harness.configure(trigger, args.trigger_line, args.output_line)
+
+      for format_name in args.formats:
+        for sync in ([False, True] if args.sync else [False]):
+          name = f'{trigger}_{format_name}' + ('_fsync' if sync else '')
+          with tempfile.TemporaryDirectory(dir=args.output) as directory:
+            rows = harness.run(trigger, SEGMENT_WRITERS[format_name], args.frames, directory, sync, args.interval)
+
+          write_rows(os.path.join(args.output, f'latency_{name}.csv'), rows)
+          report[name] = summarize(rows)
+
+          stages = ', '.join(
+            f'{stage} {report[name][stage]["p50_ms"]:.2f}/{report[name][stage]["p99_ms"]:.2f}'
+            for stage in STAGES if stage in report[name]
+          )
+          print(f'{name}: {report[name]["frames"]}/{report[name]["triggers"]} frames; p50/p99 ms: {stages}')
+  finally:
+    camera.Close()
+
+  report_path = os.path.join(args.output, 'latency.json')
+  with open(report_path, 'w') as f:
+    json.dump(report, f, indent=2)
+  print(f'Wrote {report_path}')
+
+
+if __name__ == '__main__':
+  main()
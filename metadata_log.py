@@ -0,0 +1,14 @@
+import csv
+
+METADATA_COLUMNS = ["Timestamp_ns", "LineStatusAll", "CounterValue"]
+
+
+def write_metadata(path, metadata, extra_columns=None):
+  """Write a segment's (Timestamp_ns, LineStatusAll, CounterValue) rows as CSV, plus any per-frame columns in
+  extra_columns (name -> sequence with one value per row)."""
+  extra_columns = extra_columns or {}
+
+  with open(path, 'w', newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(METADATA_COLUMNS + list(extra_columns))
+    writer.writerows(row + tuple(values) for row, *values in zip(metadata, *extra_columns.values()))
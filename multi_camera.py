@@ -1,38 +1,119 @@
 import cv2
-import enum
-import itertools
 import os
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
+import queue
+import time
 
-from pypylon import pylon, genicam
+from pypylon import pylon
 from datetime import datetime, timedelta
+from session_catalog import SessionCatalog, segment_stats
+from frame_quality import FrameQualityWorker
+from segment_writers import AviSegmentWriter
+from tiled_writer import TiledSegmentWriter
+from devices import create_device, merge_device_maps
+from packed_formats import PACKED_FORMATS, bit_depth, unpack
+from camera_events import CameraEventMonitor
+from scheduling import apply_role
+from acquisition_log import AcquisitionLog
+from proxy_writer import ProxyWorker
+from rig_config import RigConfig, apply_plan, compile_plan, emulated_settings
 
 class Camera:
-  def __init__(self, name):
+  def __init__(self, name, output_root, segment_writer, log, segment_options=None):
     self.name = name
-    self.output_directory = os.path.join('D', os.path.sep, 'abi_data', 'raw_data', 'setup', 'test_cameras', self.name)
+    self.log = log
+    self.segment_writer = segment_writer
+    self.segment_options = segment_options or {}
+    self.output_directory = os.path.join(output_root, self.name)
     self.metadata = []
     self.video_timestamp = None
+    self.total_frames = 0
 
     # We'll start a new video whenever the beam is broken, so just make a placeh
-    self.video_writer: cv2.VideoWriter = None
+    self.video_writer = None
 
     os.makedirs(self.output_directory, exist_ok=True)
 
+  def start_video(self, video_timestamp, fourcc, frame_rate, output_resolution, tiled=None, position=None):
+    self.video_timestamp = video_timestamp
+    file_name = f"{self.name}_{self.video_timestamp}{self.segment_writer.extension}"
+    self.video_path = os.path.join(self.output_directory, file_name)
+    self.metadata_path = os.path.join(self.output_directory, f'metadata_{self.name}_{self.video_timestamp}')
+
+    if tiled:
+      # In tiled mode this camera's frames go into its tile of the shared video; only the metadata stays per camera
+      self.video_writer = tiled.tile(position, self.metadata_path)
+      self.video_path = tiled.video_path
+    else:
+      self.log.info('video_start', 'Starting new video for {camera} at {path}', camera=self.name, path=self.video_path)
+
+      self.video_writer = self.segment_writer(
+        self.video_path,
+        self.metadata_path,
+        fourcc,
+        frame_rate,
+        output_resolution,
+        **self.segment_options
+      )
+
+    # Some formats (HDF5) keep the metadata in the video file itself
+    self.metadata_path = self.video_writer.metadata_path
+    self.metadata = []
+
+  def finish_video(self, catalog, quality, events):
+    self.log.info('video_finish', 'Finishing previous video for {camera}', camera=self.name)
+    self.video_writer.close(self.metadata, quality.collect(self.name, len(self.metadata)))
+    if self.video_writer.stats:
+      self.log.info('segment_writer_stats', '{camera} segment writer: {stats}', camera=self.name,
+                    segment=self.video_timestamp, stats=self.video_writer.stats)
+    self.video_writer = None
+
+    catalog.add_segment(self.name, self.video_timestamp, self.video_path, self.metadata_path, self.metadata)
+
+    events_path = os.path.join(self.output_directory, f'events_{self.name}_{self.video_timestamp}.csv')
+    event_counts = events.collect(self.name, self.metadata, events_path)
+    if event_counts['FrameStartOvertrigger']:
+      self.log.warning('overtrigger', '{camera}: {overtriggers} triggers arrived faster than it could take frames',
+                       camera=self.name, segment=self.video_timestamp, overtriggers=event_counts['FrameStartOvertrigger'])
+
+    start_ns, end_ns, frame_count, dropped = segment_stats(self.metadata)
+    self.metadata = []
+
+    return {
+      'camera': self.name,
+      'segment': self.video_timestamp,
+      'video_path': self.video_path,
+      'metadata_path': self.metadata_path,
+      'start_ns': start_ns,
+      'end_ns': end_ns,
+      'frame_count': frame_count,
+      'dropped_frames': dropped,
+      'events_path': events_path,
+      'events': event_counts
+    }
+
 
 class Context:
-  def __init__(self):
+  def __init__(self, camera_names=('camA', 'camB', 'camC', 'camD'), output_root=None, emulated=False, frame_bus=None,
+               device_map=None, segment_writer=AviSegmentWriter, tiled=False, pixel_format=None, proxies=True,
+               rig=None, segment_options=None):
+    # Packed 10/12-bit formats are unpacked to uint16 on the host, which only some segment writers can store
+    if pixel_format and pixel_format not in PACKED_FORMATS:
+      raise ValueError(f'Unsupported pixel format {pixel_format}; expected one of {", ".join(PACKED_FORMATS)}')
+    if pixel_format and (tiled or not segment_writer.high_bit_depth):
+      raise ValueError(f'{pixel_format} frames are 16-bit and can only be recorded with the hdf5 format, without tiling')
+
     self.cameras = {}
-    self.camera_names = ['camA', 'camB', 'camC', 'camD']
+    self.camera_names = list(camera_names)
     self.num_cameras = len(self.camera_names)
-    self.trigger_line = 3
-    self.trigger_line_id = f'Line{self.trigger_line}'
+
+    # Camera settings come from the rig description (see rig_config.py); its defaults are what this script always set.
+    # The cameras are triggered together, so frame rate and video size are taken from the first one
+    self.rig = rig or RigConfig()
+    settings = self.rig.settings(self.camera_names[0])
     self.fourcc = cv2.VideoWriter_fourcc(*'XVID')
-    self.frame_rate = 200.0
+    self.frame_rate = float(settings['frame_rate'] or 200.0)
     self.sampling_rate = 1.0 / self.frame_rate
-    self.output_resolution = (800, 600)
+    self.output_resolution = (settings['roi']['width'], settings['roi']['height'])
 
     # The cameras are triggered by an Arduino; when we don't get triggered within a certain amount of time, we assume the beam
     # has become unbroken
@@ -40,116 +121,268 @@ class Context:
     self.frame_time = 0
     self.max_frame_delta = timedelta(seconds=self.sampling_rate * 4)
 
+    # Frames are polled with a short timeout instead of waiting forever. When none of the cameras has been triggered for
+    # idle_timeout, the open videos are finished right away rather than when the next beam break arrives
+    self.retrieve_timeout_ms = 50
+    self.idle_timeout = timedelta(seconds=0.25)
+    self.last_frame_time = 0.0
+    self.recording = False
+
+    # When a coordinator (see multi_host.py) drives this context, it decides where segments start and stop instead of the
+    # beam timing, and its commands are run on the grab thread between frames. Frames are then polled with a much shorter
+    # timeout, so a command waits at most command_poll_ms (or one frame) instead of retrieve_timeout_ms
+    self.auto_segment = True
+    self.command_poll_ms = 2
+    self.commands = queue.SimpleQueue()
+    self.running = True
+    self.frames_discarded = 0
+
+    # Camera emulation (PYLON_CAMEMU) has no I/O lines, chunks or auto gain, so emulated cameras free-run at the frame
+    # rate and per-frame metadata comes from the grab result instead
+    self.emulated = emulated
+
+    # Per-frame brightness, saturation and motion metrics, computed off the grab loop and added to each camera's metadata
+    # With pixel_format set (Mono10p or Mono12p), frames are unpacked to uint16 instead of going through the converter
+    self.pixel_format = pixel_format
+    saturation_level = (1 << bit_depth(self.pixel_format)) - 1 if self.pixel_format else 255
+    self.quality = FrameQualityWorker(saturation_level=saturation_level)
+
+    # Low-resolution, decimated review copies of every camera's segments, encoded from the same frames in the background
+    self.proxies = None
+    if proxies:
+      self.proxies = ProxyWorker(self.frame_rate, bit_depth=bit_depth(self.pixel_format) if self.pixel_format else 8)
+
+    # With tiled set, each trigger's frames from all cameras are packed into one mosaic and encoded as a single video
+    self.tiled = tiled
+
+    # Optional frame_bus.FrameBus; when set, every camera's frames and chunk metadata are published for live consumers
+    self.frame_bus = frame_bus
+
     # Create an image format converter. This is used to convert the raw frames to something that can be written to a video
     self.converter = pylon.ImageFormatConverter()
     self.converter.OutputPixelFormat = pylon.PixelType_BGR8packed  # For OpenCV (color)
     self.converter.OutputBitAlignment = pylon.OutputBitAlignment_MsbAligned
 
+    # Every finished segment is indexed, across all cameras, in one catalog next to the per-camera directories
+    self.output_root = output_root or os.path.join('D', os.path.sep, 'abi_data', 'raw_data', 'setup', 'test_cameras')
+    os.makedirs(self.output_root, exist_ok=True)
+    self.catalog = SessionCatalog(os.path.join(self.output_root, 'catalog.sqlite'))
+
+    # Segment boundaries and other diagnostics are logged as JSON lines from a background thread, not printed in the loop
+    self.log = AcquisitionLog(os.path.join(self.output_root, 'acquisition.jsonl'))
+
+    # Camera events (overtriggers, exposure ends, ...) are counted and logged per segment next to each camera's metadata
+    self.events = CameraEventMonitor(log=self.log)
+
     # Discover and connect to camera
     tlf = pylon.TlFactory.GetInstance()
 
-    # For multuple cameras: 
-    devices = tlf.EnumerateDevices([])
+    # For multuple cameras: with a device map each name is opened by its serial number, so names stay attached to the
+    # same physical camera. Names without one (e.g. emulated cameras) get the remaining cameras in enumeration order.
+    # Serials in the rig description take precedence over the device map
+    device_map = device_map or {}
+    if not self.emulated:
+      device_map = merge_device_maps(device_map, self.rig.device_map())
+    devices = []
+    if any(name not in device_map for name in self.camera_names):
+      serials = {entry['serial'] for entry in device_map.values()}
+      devices = [device for device in tlf.EnumerateDevices([]) if device.GetSerialNumber() not in serials]
     self.cam_array = pylon.InstantCameraArray(self.num_cameras)
     for idx, camera in enumerate(self.cam_array):
-      self.cameras[idx] = Camera(self.camera_names[idx])
+      self.cameras[idx] = Camera(self.camera_names[idx], self.output_root, segment_writer, self.log, segment_options)
 
-      camera.Attach(tlf.CreateDevice(devices[idx]))
+      if self.camera_names[idx] in device_map:
+        camera.Attach(create_device(tlf, self.camera_names[idx], device_map))
+      elif devices:
+        camera.Attach(tlf.CreateDevice(devices.pop(0)))
+      else:
+        raise RuntimeError(f'No camera left for {self.camera_names[idx]}; is it connected?')
       camera.Open()
 
       camera.SetCameraContext(idx)
 
-      # Load the default camera configuration 
-      camera.UserSetSelector.Value = "Default"
-      camera.UserSetLoad.Execute()
-
-      # Set the chunks you want (metadata). Here we want to sample IO lines on each framestart trigger 
-      chunks = ["LineStatusAll", "Timestamp", "CounterValue"]
-      camera.ChunkModeActive.SetValue(True) #attach metadata to each image 
-      for chunk in chunks:
-        camera.ChunkSelector.SetValue(chunk) #metadata about IO line status for each image (state of TTL pulse)
-        if chunk == "CounterValue":
-          camera.CounterSelector.SetValue("Counter1")
-          camera.CounterEventSource.SetValue("FrameStart")
-        camera.ChunkEnable.SetValue(True) #activates chunk you are interested in (LineStatus)
-
-        if not camera.ChunkEnable.GetValue():
-          print(f'Tried to enable chunk {chunk} for camera {camera.name}, but it reported as disabled')
-
-      # Set image quality and format settings 
-      camera.Height.SetValue(600)
-      camera.Width.SetValue(800)
-      camera.ExposureTime.SetValue(3000)
-      camera.AcquisitionFrameRateEnable.SetValue(True)
-      camera.AcquisitionFrameRate.SetValue(200)
-      camera.GainAuto.SetValue("Continuous")
-
-      # Setup the trigger/acquisition controls 
-      camera.TriggerSelector.SetValue("FrameStart")
-      camera.TriggerActivation.SetValue("RisingEdge")
-      camera.TriggerSource.SetValue(self.trigger_line_id)
-      camera.TriggerMode.SetValue("On")
+      # Chunks (IO line status, timestamp and FrameStart counter on every frame), ROI, exposure and trigger, writing only
+      # the nodes that differ from what the camera already has
+      camera_settings = self.rig.settings(self.camera_names[idx])
+      if self.pixel_format:
+        camera_settings['pixel_format'] = self.pixel_format
+      if self.emulated:
+        camera_settings = emulated_settings(camera_settings)
+
+      configuration = apply_plan(camera, compile_plan(camera_settings), skip_unavailable=self.emulated)
+      self.log.info('configured', 'Configured {camera}: {summary}', camera=self.camera_names[idx],
+                    summary=configuration.summary())
+      for node, selectors, expected, actual in configuration.mismatches:
+        self.log.warning('setting_mismatch', 'Tried to set {node} to {expected} ({selectors}) on {camera}, but it reads {actual}',
+                         node=node, selectors=dict(selectors), expected=expected, actual=actual, camera=self.camera_names[idx])
+
+      if not self.emulated:
+        self.events.enable(camera, self.camera_names[idx])
+
+  def start_videos(self, video_timestamp=None):
+    # All cameras share the segment label so their files can be matched up later
+    video_timestamp = video_timestamp or datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')
+
+    tiled = None
+    if self.tiled:
+      tiled_directory = os.path.join(self.output_root, 'tiled')
+      os.makedirs(tiled_directory, exist_ok=True)
+
+      video_path = os.path.join(tiled_directory, f'tiled_{video_timestamp}.avi')
+      self.log.info('tiled_start', 'Starting new tiled video at {path}', path=video_path)
+      tiled = TiledSegmentWriter(
+        video_path,
+        os.path.join(tiled_directory, f'tiles_{video_timestamp}.csv'),
+        [camera.name for _, camera in sorted(self.cameras.items())],
+        self.fourcc,
+        self.frame_rate,
+        self.output_resolution
+      )
+
+    for position, camera in sorted(self.cameras.items()):
+      camera.start_video(video_timestamp, self.fourcc, self.frame_rate, self.output_resolution, tiled, position)
+
+      if self.proxies:
+        self.proxies.start_segment(
+          camera.name,
+          os.path.join(camera.output_directory, f'proxy_{camera.name}_{video_timestamp}.avi'),
+          os.path.join(camera.output_directory, f'thumbnails_{camera.name}_{video_timestamp}.jpg')
+        )
+
+    self.recording = True
+
+  def finish_videos(self):
+    segments = []
+    for camera in self.cameras.values():
+      # A camera may not have been part of any segment yet
+      if camera.video_writer:
+        if self.proxies:
+          self.proxies.finish_segment(camera.name)
+        segments.append(camera.finish_video(self.catalog, self.quality, self.events))
+
+    # Every camera sees the same triggers, so differing frame counts mean one of them dropped or missed frames
+    if segments:
+      sync_status = 'ok' if len({segment['frame_count'] for segment in segments}) == 1 else 'frame_count_mismatch'
+      self.catalog.set_sync_status(segments[0]['segment'], sync_status)
+      for segment in segments:
+        segment['sync_status'] = sync_status
+
+    self.recording = False
+    return segments
+
+  def run_commands(self):
+    while True:
+      try:
+        command, reply = self.commands.get_nowait()
+      except queue.Empty:
+        return
+
+      try:
+        reply.put(command())
+      except Exception as e:
+        reply.put(e)
+
+  def read_metadata(self, grab):
+    if self.emulated:
+      return grab.GetTimeStamp(), 0, grab.GetImageNumber()
+
+    return (
+      grab.ChunkTimestamp.Value,
+      grab.ChunkLineStatusAll.Value,
+      grab.ChunkCounterValue.Value
+    )
+
+  def read_frame(self, grab):
+    # Packed frames skip the converter: the vectorized unpacker is faster, and keeps all 10/12 bits
+    if self.pixel_format:
+      return unpack(grab.GetBuffer(), grab.GetWidth(), grab.GetHeight(), self.pixel_format)
+
+    return self.converter.Convert(grab).GetArray()
 
   def run_loop(self):
+    # Before anything is started from this thread, so pylon's own grab threads end up on the grab CPUs too
+    apply_role('grab')
+    self.quality.start()
+    self.events.start()
+    if self.proxies:
+      self.proxies.start()
     self.cam_array.StartGrabbing(pylon.GrabStrategy_OneByOne, pylon.GrabLoop_ProvidedByUser) # Starts a steady stream of images, provides 1 frame at a time when triggered 
     
     try:
-      while True:
-        grab = self.cam_array.RetrieveResult(pylon.waitForever, pylon.TimeoutHandling_Return)
+      while self.running:
+        self.run_commands()
+
+        timeout_ms = self.retrieve_timeout_ms if self.auto_segment else self.command_poll_ms
+        grab = self.cam_array.RetrieveResult(timeout_ms, pylon.TimeoutHandling_Return)
+
+        # Nothing was triggered within the timeout. Once all cameras have been quiet for idle_timeout, finish the segment
+        if not grab.IsValid():
+          if self.auto_segment and self.recording and time.monotonic() - self.last_frame_time > self.idle_timeout.total_seconds():
+            self.log.info('idle_timeout', 'No trigger for {idle_s}s; finishing segment', idle_s=self.idle_timeout.total_seconds())
+            self.finish_videos()
+          continue
+
+        self.last_frame_time = time.monotonic()
+
         camera_id = grab.GetCameraContext()
         frame_camera = self.cameras[camera_id]
+        frame_camera.total_frames += 1
+
+        if not self.auto_segment:
+          # Frames between coordinated segments aren't recorded
+          if not self.recording:
+            self.frames_discarded += 1
+            continue
 
-        if frame_camera.name == self.frame_sentinel:
+        elif frame_camera.name == self.frame_sentinel:
           frame_delta = grab.GetTimeStamp() - self.frame_time
           max_frame_delta = self.max_frame_delta.total_seconds() * (10 ** 9) # Convert our delta from seconds to nanoseconds
 
           self.frame_time = grab.GetTimeStamp()
 
-          if frame_delta > max_frame_delta:
-            # print(f'Frame delta exceeded; delta = {frame_delta}, max delta = {max_frame_delta}; assuming beam status changed and starting a new video')
-            print(f'{frame_delta / 1000000}, {max_frame_delta / 1000000}')
-
-            for camera in self.cameras.values():
-              # If this is our first video, there's no current video to finalize
-              if camera.video_writer:
-                print('Finishing previous video')
-                camera.video_writer.release()
+          # Only a gap since the sentinel's last frame in this segment ends it. After an idle timeout another camera's
+          # frame may already have opened the next segment, and the gap back to the previous trial mustn't close it again
+          if frame_delta > max_frame_delta and self.recording and frame_camera.metadata:
+            self.log.info('frame_delta_exceeded', 'Frame delta {delta_ms:.1f}ms > {max_delta_ms:.1f}ms; finishing segment',
+                          delta_ms=frame_delta / 1000000, max_delta_ms=max_frame_delta / 1000000)
 
-                file_name = f'metadata_{camera.name}_{camera.video_timestamp}'
-                file_path = os.path.join(camera.output_directory, file_name)
-                df = pd.DataFrame(camera.metadata, columns=["Timestamp_ns", "LineStatusAll", "CounterValue"])
-                df.to_csv(file_path, index=False)
+            self.finish_videos()
 
-              # Start a new video
-              camera.video_timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')
-              file_name = f"{camera.name}_{camera.video_timestamp}.avi"
-              file_path = os.path.join(camera.output_directory, file_name)
+        # Any camera's first frame after an idle period opens the next segment, since the sentinel's frame for the same
+        # trigger isn't guaranteed to be retrieved first
+        if not self.recording:
+          self.start_videos()
 
-              print(f'Starting new video for {camera.name} at {file_path}')
+        frame = self.read_frame(grab)
+        metadata = self.read_metadata(grab)
 
-              camera.video_writer = cv2.VideoWriter(
-                file_path,
-                self.fourcc,
-                self.frame_rate,
-                self.output_resolution
-              )
+        frame_camera.video_writer.write(frame, metadata)
+        self.quality.submit(frame_camera.name, len(frame_camera.metadata), frame)
+        if self.proxies:
+          self.proxies.submit(frame_camera.name, len(frame_camera.metadata), frame)
+        frame_camera.metadata.append(metadata)
 
-              camera.metadata = []
-
-        frame = self.converter.Convert(grab).GetArray()
-        frame_camera.video_writer.write(frame)
-
-        frame_camera.metadata.append((
-          grab.ChunkTimestamp.Value,
-          grab.ChunkLineStatusAll.Value,
-          grab.ChunkCounterValue.Value
-        ))
+        if self.frame_bus:
+          self.frame_bus.publish(frame_camera.name, frame, metadata)
 
     except KeyboardInterrupt:
-       print('Recording was stopped by user.')
+       self.log.info('stopped', 'Recording was stopped by user.')
     finally:
+      # Commands are only run by this loop, so anyone still waiting on one (see multi_host.Node.call) must stop waiting
+      self.running = False
+      if self.recording:
+        self.finish_videos()
+
       self.cam_array.StopGrabbing()
       self.cam_array.Close()
+      self.catalog.close()
+      self.quality.stop()
+      self.events.stop()
+      if self.proxies:
+        self.proxies.stop()
+      if self.frame_bus:
+        self.frame_bus.close()
+      self.log.close()
       cv2.destroyAllWindows()
 
 if __name__ == '__main__':
@@ -15,10 +15,13 @@ import cv2
 import os
 import time
 import pandas as pd
+from acquisition_log import AcquisitionLog
+from rig_config import load_rig, apply_plan, compile_plan
+from devices import create_device, load_device_map, merge_device_maps
 
 
 ##### Define a function to start and stop grabbing images with a TTL pulse #####
-def grab_during_ttl(cam_array, converter, video_writer, metadata_list, trigger_line_bit=3):
+def grab_during_ttl(cam_array, converter, video_writer, metadata_list, trigger_line_bit=3, log=None):
     """Grabs frames while TTL (beam break) line is high.
     
     Args:
@@ -27,10 +30,15 @@ def grab_during_ttl(cam_array, converter, video_writer, metadata_list, trigger_l
         video_writer: OpenCV VideoWriter object.
         metadata_list: list to append (timestamp, line_status, counter_value).
         trigger_line_bit: Which digital line to monitor (default is Line3 → bit 3).
+        log: AcquisitionLog for diagnostics; per-frame messages are rate limited. A console-only one, closed again on
+            return, if not given.
     """
 
     cam_array.StartGrabbing(pylon.GrabStrategy_OneByOne, pylon.GrabLoop_ProvidedByUser)
-    print("Waiting for TTL HIGH to begin recording...")
+    owns_log = log is None
+    if owns_log:
+        log = AcquisitionLog()
+    log.info("waiting", "Waiting for TTL HIGH to begin recording...")
 
     grabbing = False
 
@@ -41,27 +49,31 @@ def grab_during_ttl(cam_array, converter, video_writer, metadata_list, trigger_l
                     continue
 
                 # Read chunk data
-                timestamp = grab.ChunkTimestamp
+                timestamp = grab.ChunkTimestamp.Value
                 line_status = grab.ChunkLineStatusAll.Value
                 counter_val = grab.ChunkCounterValue.Value
                 ttl_state = (line_status >> trigger_line_bit) & 1
 
                 if ttl_state and not grabbing:
-                    print("TTL HIGH detected. Starting frame capture.")
+                    log.info("ttl_high", "TTL HIGH detected. Starting frame capture.", timestamp=timestamp)
                     grabbing = True
 
                 if grabbing:
                     frame = converter.Convert(grab).GetArray()
                     video_writer.write(frame)
                     metadata_list.append((timestamp, line_status, counter_val))
-                    print(f"Grabbed frame at timestamp {timestamp}, TTL state: {ttl_state}") 
+                    # Logged for every frame, but written at most once a second with a count of the rest
+                    log.frame("frame_grabbed", "Grabbed frame at timestamp {timestamp}, TTL state: {ttl_state}",
+                              timestamp=timestamp, ttl_state=ttl_state, counter=counter_val)
 
                     if not ttl_state:
-                        print("TTL LOW detected. Stopping capture.")
+                        log.info("ttl_low", "TTL LOW detected. Stopping capture.", timestamp=timestamp)
                         break  # Stop when TTL falls
         except genicam.TimeoutException:
-            print("No frame received — probably no trigger")
+            log.info("no_frame", "No frame received — probably no trigger")
     cam_array.StopGrabbing()
+    if owns_log:
+        log.close()
 
 ##### Multicamera setup #####
 
@@ -84,50 +96,37 @@ tlf = pylon.TlFactory.GetInstance() #discover and connect to cameras
 # List all available devices
 devices = tlf.EnumerateDevices()
 
+# Per-camera settings. Cameras are opened by their serial numbers from the rig file (or the device map), so each name's
+# settings go to the same physical camera; names without a serial fall back to enumeration order
+rig = load_rig()
+device_map = merge_device_maps(load_device_map(), rig.device_map())
+
 # Creates an array of cameras (objects) for handling multiple cameras.
 cam_array = pylon.InstantCameraArray(num_cameras)
 
 # Maps each camera slot in the cam_array to a real, connected camera device.
 for idx, cam in enumerate(cam_array): 
-    cam.Attach(tlf.CreateDevice(devices[idx]))
-    cam.Attach(tlf.CreateDevice(devices[idx]))
+    if camera_names[idx] in device_map:
+        cam.Attach(create_device(tlf, camera_names[idx], device_map))
+    else:
+        cam.Attach(tlf.CreateDevice(devices[idx]))
     cam.Open()
-    cam.UserSetSelector.Value = "Default"
-    cam.UserSetLoad.Execute()
-
-    # Set the chunks you want (metadata). Here we want to sample IO lines on each framestart trigger  
-    chunks = ["LineStatusAll", "Timestamp", "CounterValue"]
-    cam.ChunkModeActive.SetValue(True) #attach metadata to each image 
-    for chunk in chunks:
-        cam.ChunkSelector.SetValue(chunk) #metadata about IO line status for each image (state of TTL pulse)
-        if chunk == "CounterValue": 
-            cam.CounterSelector.SetValue("Counter1")
-        cam.CounterEventSource.SetValue("FrameStart")
-        cam.ChunkEnable.SetValue(True) #activates chunk you are interested in (LineStatus)
-    # Confirm chunk is enabled
-        #is_enabled = cam.ChunkEnable.GetValue()
-        #print(f"Chunk '{chunk}': {'ENABLED' if is_enabled else 'disabled'}")
-    
-
-    # Set image quality and format settings 
-    cam.Height.SetValue(600)
-    cam.Width.SetValue(800)
-    cam.ExposureTime.SetValue(3000)
-    cam.AcquisitionFrameRateEnable.SetValue(True)
-    cam.AcquisitionFrameRate.SetValue(200)
-    cam.GainAuto.SetValue("Continuous")
 
-    # Setup the trigger/acquisition controls 
-    cam.TriggerSelector.SetValue("FrameStart")
-    cam.TriggerActivation.SetValue("RisingEdge")
-    cam.TriggerSource.SetValue("Line3")
-    cam.TriggerMode.SetValue("On")
+    # Chunks (IO line status, timestamp and FrameStart counter on every frame), ROI, exposure and trigger, as described
+    # for this camera in the rig file (rig_config.py). Only the nodes that differ from what the camera has are written
+    configuration = apply_plan(cam, compile_plan(rig.settings(camera_names[idx])))
+    print(f"Configured {camera_names[idx]}: {configuration.summary()}")
+    for node, selectors, expected, actual in configuration.mismatches:
+        print(f"Tried to set {node} to {expected} ({dict(selectors)}), but it reads {actual}")
 
 # Create an image format converter
 converter = pylon.ImageFormatConverter()
 converter.OutputPixelFormat = pylon.PixelType_BGR8packed  # For OpenCV (color)
 converter.OutputBitAlignment = pylon.OutputBitAlignment_MsbAligned
 
+# # Diagnostics go to a JSON lines log next to the camera folders, written on a background thread
+# log = AcquisitionLog(os.path.join(general_dir, "acquisition.jsonl"))
+#
 # try:
 #     while True:
 #         #timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
@@ -144,7 +143,7 @@ converter.OutputBitAlignment = pylon.OutputBitAlignment_MsbAligned
 #         )
 
 #         metadata = []
-#         grab_during_ttl(cam_array, converter, video_writer, metadata)
+#         grab_during_ttl(cam_array, converter, video_writer, metadata, log=log)
 
 #         # Save metadata
 #         metadata_filename = f"metadata_{timestamp}.csv"
@@ -154,8 +153,9 @@ converter.OutputBitAlignment = pylon.OutputBitAlignment_MsbAligned
 
 #         video_writer.release()
 # except KeyboardInterrupt:
-#     print("Recording stopped by user.")
+#     log.info("stopped", "Recording stopped by user.")
 # finally:
+#     log.close()
 #     cam_array.Close()
 #     cv2.destroyAllWindows()
 
@@ -0,0 +1,341 @@
+import argparse
+import csv
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from devices import DEFAULT_DEVICE_MAP
+from rig_config import DEFAULT_RIG_CONFIG
+from scheduling import add_arguments as add_scheduling_arguments
+from segment_writers import add_arguments as add_writer_arguments
+
+# Nodes and the coordinator exchange one JSON object per line over a plain TCP connection. Every request gets exactly one
+# reply, so the coordinator can talk to each node with a simple send/receive pair.
+
+
+def send_message(stream, message):
+  stream.write(json.dumps(message).encode() + b'\n')
+  stream.flush()
+
+
+def receive_message(stream):
+  line = stream.readline()
+  if not line:
+    raise ConnectionError('Connection closed')
+
+  return json.loads(line)
+
+
+class Node:
+  """Acquisition node: runs a multi_camera.Context for its own cameras and takes segment commands over TCP."""
+
+  def __init__(self, context, port):
+    self.context = context
+    self.name = socket.gethostname() + f':{port}'
+
+    # The coordinator defines the segments, so beam timing no longer starts or finishes videos on this node
+    context.auto_segment = False
+
+    node = self
+
+    class Handler(socketserver.StreamRequestHandler):
+      def handle(self):
+        while True:
+          try:
+            message = receive_message(self.rfile)
+          except ConnectionError:
+            return
+
+          send_message(self.wfile, node.handle(message))
+
+    self.server = socketserver.ThreadingTCPServer(('', port), Handler)
+    self.server.daemon_threads = True
+    self.server_thread = threading.Thread(target=self.server.serve_forever, name='node-server', daemon=True)
+
+  def call(self, function, timeout=30.0):
+    # Everything touching the cameras or video writers has to happen on the grab thread, so hand it over and wait. If
+    # the grab loop has exited (camera error, shutdown) nothing will ever run the command, so don't wait for it forever
+    reply = queue.SimpleQueue()
+    self.context.commands.put((function, reply))
+    deadline = time.monotonic() + timeout
+    while True:
+      try:
+        result = reply.get(timeout=0.1)
+        break
+      except queue.Empty:
+        if not self.context.running and reply.empty():
+          raise RuntimeError('Acquisition loop is not running')
+        if time.monotonic() > deadline:
+          raise TimeoutError(f'No reply from the acquisition loop within {timeout:.0f}s')
+
+    if isinstance(result, Exception):
+      raise result
+
+    return result
+
+  def handle(self, message):
+    command = message.get('command')
+    try:
+      if command == 'start':
+        def start():
+          segments = self.context.finish_videos() if self.context.recording else []
+          self.context.start_videos(message['label'])
+          return segments
+
+        return {'ok': True, 'segments': self.with_metadata(self.call(start))}
+
+      if command == 'stop':
+        return {'ok': True, 'segments': self.with_metadata(self.call(self.context.finish_videos))}
+
+      if command == 'stats':
+        return {'ok': True, 'stats': self.call(self.stats)}
+
+      if command == 'shutdown':
+        def shutdown():
+          self.context.running = False
+
+        self.call(shutdown)
+        return {'ok': True}
+
+      return {'ok': False, 'error': f'Unknown command {command}'}
+    except Exception as e:
+      return {'ok': False, 'error': repr(e)}
+
+  def stats(self):
+    return {
+      'node': self.name,
+      'recording': self.context.recording,
+      'frames_discarded': self.context.frames_discarded,
+      'quality_frames_skipped': self.context.quality.dropped,
+      'camera_events': self.context.events.counts,
+      'cameras': {
+        camera.name: {'total_frames': camera.total_frames, 'segment_frames': len(camera.metadata)}
+        for camera in self.context.cameras.values()
+      }
+    }
+
+  def with_metadata(self, segments):
+    # Ship each segment's metadata CSV along with its summary so the coordinator can merge them without shared storage
+    for segment in segments:
+      segment['node'] = self.name
+      if segment['metadata_path'].endswith('.h5'):
+        segment['metadata_csv'] = self.hdf5_metadata_csv(segment['metadata_path'])
+      else:
+        with open(segment['metadata_path']) as f:
+          segment['metadata_csv'] = f.read()
+
+    return segments
+
+  def hdf5_metadata_csv(self, path):
+    # HDF5 segments keep their metadata columns in the video file; send them as the same CSV the other formats write
+    from metadata_log import METADATA_COLUMNS
+    from segment_writers import read_segment_metadata
+
+    columns = read_segment_metadata(path)
+    names = METADATA_COLUMNS + sorted(name for name in columns if name not in METADATA_COLUMNS)
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(names)
+    writer.writerows(zip(*(columns[name].tolist() for name in names)))
+
+    return text.getvalue()
+
+  def run(self):
+    self.server_thread.start()
+    print(f'Node {self.name} serving cameras {", ".join(self.context.camera_names)}')
+    try:
+      self.context.run_loop()
+    finally:
+      self.server.shutdown()
+      self.server.server_close()
+
+
+class Coordinator:
+  """Drives several acquisition nodes: starts and stops segments on all of them together and merges their metadata."""
+
+  def __init__(self, addresses, output_directory):
+    self.output_directory = output_directory
+    self.label = None
+    self.connections = {}
+    for address in addresses:
+      host, port = address.rsplit(':', 1)
+      connection = socket.create_connection((host, int(port)))
+      connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      self.connections[address] = connection.makefile('rwb')
+
+    self.pool = ThreadPoolExecutor(max_workers=len(self.connections))
+    os.makedirs(self.output_directory, exist_ok=True)
+
+  def request(self, address, message):
+    stream = self.connections[address]
+    send_message(stream, message)
+    reply = receive_message(stream)
+    if not reply['ok']:
+      raise RuntimeError(f'Node {address} failed {message["command"]}: {reply["error"]}')
+
+    return reply
+
+  def broadcast(self, message):
+    # Sent to every node concurrently. A node runs the command between frames (see Context.command_poll_ms), so segment
+    # boundaries on different nodes are apart by network latency plus up to a couple of milliseconds. Boundaries follow
+    # the wall clock, not the trigger counter: a trigger that arrives within that window can land in different segments
+    # on different nodes, which merge() reports as frame_count_mismatch
+    futures = {address: self.pool.submit(self.request, address, message) for address in self.connections}
+    return {address: future.result() for address, future in futures.items()}
+
+  def start_segment(self, label=None):
+    """Start a new segment with the same label on every node. Returns the merged session for any segment it finished."""
+    label = label or datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')
+    replies = self.broadcast({'command': 'start', 'label': label})
+    previous, self.label = self.label, label
+
+    return self.merge(previous, replies) if previous else None
+
+  def stop_segment(self):
+    replies = self.broadcast({'command': 'stop'})
+    label, self.label = self.label, None
+
+    return self.merge(label, replies) if label else None
+
+  def stats(self):
+    return {address: reply['stats'] for address, reply in self.broadcast({'command': 'stats'}).items()}
+
+  def merge(self, label, replies):
+    """Combine every camera's metadata for one segment into a single session CSV plus a JSON summary."""
+    import pandas as pd
+
+    frames = []
+    summary = []
+    for reply in replies.values():
+      for segment in reply['segments']:
+        df = pd.read_csv(io.StringIO(segment.pop('metadata_csv')))
+        df.insert(0, 'Camera', segment['camera'])
+        df.insert(0, 'Node', segment['node'])
+        frames.append(df)
+        summary.append(segment)
+
+    if not summary:
+      return None
+
+    frame_counts = {segment['frame_count'] for segment in summary}
+    session = {
+      'segment': label,
+      'sync_status': 'ok' if len(frame_counts) == 1 else 'frame_count_mismatch',
+      'cameras': summary
+    }
+
+    metadata_path = os.path.join(self.output_directory, f'session_{label}.csv')
+    pd.concat(frames, ignore_index=True).to_csv(metadata_path, index=False)
+    session['metadata_path'] = metadata_path
+
+    with open(os.path.join(self.output_directory, f'session_{label}.json'), 'w') as f:
+      json.dump(session, f, indent=2)
+
+    return session
+
+  def close(self, shutdown_nodes=False):
+    if shutdown_nodes:
+      self.broadcast({'command': 'shutdown'})
+
+    for stream in self.connections.values():
+      stream.close()
+
+    self.pool.shutdown()
+
+
+def run_node(args):
+  # Emulated cameras have to be requested before pylon creates its transport layers
+  if args.emulate:
+    os.environ['PYLON_CAMEMU'] = str(len(args.cameras))
+
+  from multi_camera import Context
+  from frame_bus import FrameBus
+  from devices import load_device_map
+  from segment_writers import SEGMENT_WRITERS, options_from_args
+  from scheduling import policy_from_args
+  from rig_config import load_rig
+
+  policy_from_args(args)
+  frame_bus = FrameBus(args.bus_prefix or f'pylon{args.port}') if args.publish_frames else None
+  device_map = None if args.emulate else load_device_map(args.device_map)
+  segment_writer = SEGMENT_WRITERS[args.format]
+  context = Context(camera_names=args.cameras, output_root=args.output, emulated=args.emulate, frame_bus=frame_bus,
+                    device_map=device_map, segment_writer=segment_writer, segment_options=options_from_args(args),
+                    rig=load_rig(args.rig))
+  Node(context, args.port).run()
+
+
+def run_coordinator(args):
+  coordinator = Coordinator(args.nodes, args.output)
+  print('Commands: start [label], stop, stats, quit')
+
+  try:
+    while True:
+      try:
+        words = input('> ').split()
+      except EOFError:
+        break
+
+      if not words:
+        continue
+
+      if words[0] == 'start':
+        session = coordinator.start_segment(words[1] if len(words) > 1 else None)
+        if session:
+          print(f'Finished segment {session["segment"]} ({session["sync_status"]}): {session["metadata_path"]}')
+        print(f'Recording segment {coordinator.label}')
+      elif words[0] == 'stop':
+        session = coordinator.stop_segment()
+        if session:
+          print(f'Finished segment {session["segment"]} ({session["sync_status"]}): {session["metadata_path"]}')
+      elif words[0] == 'stats':
+        print(json.dumps(coordinator.stats(), indent=2))
+      elif words[0] == 'quit':
+        break
+      else:
+        print(f'Unknown command {words[0]}')
+  finally:
+    if coordinator.label:
+      coordinator.stop_segment()
+    coordinator.close(shutdown_nodes=args.shutdown_nodes)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Record camera groups on several acquisition PCs as one session')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  node_parser = commands.add_parser('node', help='Run the cameras attached to this PC')
+  node_parser.add_argument('--port', type=int, default=5800)
+  node_parser.add_argument('--cameras', nargs='+', required=True, help='Names of the cameras on this node, e.g. camA camB')
+  node_parser.add_argument('--output', help='Directory for this node\'s recordings')
+  node_parser.add_argument('--emulate', action='store_true', help='Use pylon camera emulation instead of real cameras')
+  node_parser.add_argument('--device-map', default=DEFAULT_DEVICE_MAP, help='Camera name to serial number mapping')
+  node_parser.add_argument('--rig', default=DEFAULT_RIG_CONFIG, help='Rig description with per-camera settings (rig_config.py)')
+  node_parser.add_argument('--format', choices=['avi', 'mkv', 'hdf5'], default='avi', help='Segment file format')
+  add_writer_arguments(node_parser)
+  node_parser.add_argument('--publish-frames', action='store_true', help='Publish frames on the shared-memory frame bus')
+  node_parser.add_argument('--bus-prefix', help='Frame bus ring name prefix; pylon<port> by default, so nodes on one PC '
+                                                'don\'t collide (subscribe with FrameSubscriber(camera, prefix))')
+  add_scheduling_arguments(node_parser)
+
+  coordinator_parser = commands.add_parser('coordinator', help='Drive a set of running nodes')
+  coordinator_parser.add_argument('--nodes', nargs='+', required=True, help='host:port of every node')
+  coordinator_parser.add_argument('--output', required=True, help='Directory for merged session metadata')
+  coordinator_parser.add_argument('--shutdown-nodes', action='store_true', help='Stop the nodes when quitting')
+
+  args = parser.parse_args()
+  if args.command == 'node':
+    run_node(args)
+  else:
+    run_coordinator(args)
+
+
+if __name__ == '__main__':
+  main()
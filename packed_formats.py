@@ -0,0 +1,150 @@
+import argparse
+import time
+
+import numpy as np
+
+# Host-side unpacking of the GenICam "p" pixel formats, so cameras can send 10/12-bit data over USB at 1.25/1.5 bytes
+# per pixel instead of the 2 bytes of unpacked Mono10/Mono12. Both formats pack pixels LSB first, continuously across
+# line boundaries:
+#   Mono10p: 4 pixels in 5 bytes   p0 = b0 | (b1 & 0x03) << 8,  p1 = b1 >> 2 | (b2 & 0x0F) << 6,
+#                                  p2 = b2 >> 4 | (b3 & 0x3F) << 4,  p3 = b3 >> 6 | b4 << 2
+#   Mono12p: 2 pixels in 3 bytes   p0 = b0 | (b1 & 0x0F) << 8,  p1 = b1 >> 4 | b2 << 4
+
+PACKED_FORMATS = {
+  # name: (bits per pixel, pixels per group, bytes per group)
+  'Mono10p': (10, 4, 5),
+  'Mono12p': (12, 2, 3),
+}
+
+
+def bit_depth(pixel_format):
+  return PACKED_FORMATS[pixel_format][0]
+
+
+def unpack_mono10p(groups):
+  b = groups.astype(np.uint16)
+  out = np.empty((len(groups), 4), dtype=np.uint16)
+  out[:, 0] = b[:, 0] | (b[:, 1] & 0x03) << 8
+  out[:, 1] = b[:, 1] >> 2 | (b[:, 2] & 0x0F) << 6
+  out[:, 2] = b[:, 2] >> 4 | (b[:, 3] & 0x3F) << 4
+  out[:, 3] = b[:, 3] >> 6 | b[:, 4] << 2
+  return out
+
+
+def unpack_mono12p(groups):
+  b = groups.astype(np.uint16)
+  out = np.empty((len(groups), 2), dtype=np.uint16)
+  out[:, 0] = b[:, 0] | (b[:, 1] & 0x0F) << 8
+  out[:, 1] = b[:, 1] >> 4 | b[:, 2] << 4
+  return out
+
+
+UNPACKERS = {
+  'Mono10p': unpack_mono10p,
+  'Mono12p': unpack_mono12p,
+}
+
+
+def unpack(buffer, width, height, pixel_format, msb_aligned=False):
+  """Unpack a Mono10p/Mono12p buffer into a (height, width) uint16 array.
+
+  Values are LSB aligned (0..1023 or 0..4095) like pylon's Mono16 conversion with OutputBitAlignment_LsbAligned; with
+  msb_aligned they're shifted to fill the 16-bit range instead.
+  """
+  bits, pixels_per_group, bytes_per_group = PACKED_FORMATS[pixel_format]
+  pixels = width * height
+  groups = -(-pixels // pixels_per_group)
+
+  data = np.frombuffer(buffer, dtype=np.uint8)
+  needed = groups * bytes_per_group
+  if len(data) < needed:
+    # The last group can be partially filled when the pixel count isn't a multiple of the group size
+    data = np.concatenate([data, np.zeros(needed - len(data), dtype=np.uint8)])
+
+  frame = UNPACKERS[pixel_format](data[:needed].reshape(groups, bytes_per_group)).reshape(-1)[:pixels]
+  frame = frame.reshape(height, width)
+
+  if msb_aligned:
+    frame <<= 16 - bits
+
+  return frame
+
+
+def pack(frame, pixel_format):
+  """Inverse of unpack, for tests and benchmarks without a camera."""
+  bits, pixels_per_group, bytes_per_group = PACKED_FORMATS[pixel_format]
+  pixels = frame.reshape(-1).astype(np.uint16)
+  pixels = np.concatenate([pixels, np.zeros(-len(pixels) % pixels_per_group, dtype=np.uint16)])
+
+  # Spread each group's pixels over one integer, LSB first, then take its bytes
+  p = pixels.reshape(-1, pixels_per_group).astype(np.uint64)
+  value = np.zeros(len(p), dtype=np.uint64)
+  for i in range(pixels_per_group):
+    value |= p[:, i] << np.uint64(i * bits)
+
+  return ((value[:, None] >> (np.arange(bytes_per_group, dtype=np.uint64) * np.uint64(8))) & np.uint64(0xFF)) \
+    .astype(np.uint8).tobytes()
+
+
+def verify_against_pylon(grab, pixel_format):
+  """Check unpack() against pylon's own conversion of the same grab result to Mono16. Returns True if identical."""
+  from pypylon import pylon
+
+  converter = pylon.ImageFormatConverter()
+  converter.OutputPixelFormat = pylon.PixelType_Mono16
+  converter.OutputBitAlignment = pylon.OutputBitAlignment_LsbAligned
+  expected = converter.Convert(grab).GetArray()
+
+  actual = unpack(grab.GetBuffer(), grab.GetWidth(), grab.GetHeight(), pixel_format)
+  return np.array_equal(actual, expected)
+
+
+def verify_camera(pixel_format, frames=10):
+  """Grab a few frames in pixel_format from the first camera (pylon camera emulation works) and verify each one."""
+  from pypylon import pylon
+
+  camera = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
+  camera.Open()
+  try:
+    camera.PixelFormat.SetValue(pixel_format)
+    camera.StartGrabbingMax(frames)
+    results = []
+    while camera.IsGrabbing():
+      with camera.RetrieveResult(5000, pylon.TimeoutHandling_ThrowException) as grab:
+        results.append(verify_against_pylon(grab, pixel_format))
+    return all(results)
+  finally:
+    camera.Close()
+
+
+def benchmark(width=800, height=600, repeats=200):
+  """Unpack throughput in megapixels per second on one core, per format."""
+  rng = np.random.default_rng(0)
+  results = {}
+  for pixel_format, (bits, _, _) in PACKED_FORMATS.items():
+    frame = rng.integers(0, 1 << bits, (height, width), dtype=np.uint16)
+    buffer = pack(frame, pixel_format)
+    assert np.array_equal(unpack(buffer, width, height, pixel_format), frame)
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+      unpack(buffer, width, height, pixel_format)
+    results[pixel_format] = width * height * repeats / (time.perf_counter() - start) / 1e6
+
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark packed pixel unpacking and verify it against pylon')
+  parser.add_argument('--verify', choices=sorted(PACKED_FORMATS), help='Also verify against the first connected camera')
+  args = parser.parse_args()
+
+  for pixel_format, megapixels in benchmark().items():
+    print(f'{pixel_format}: {megapixels:.0f} Mpixel/s per core ({megapixels / 0.48:.0f} fps at 800x600)')
+
+  if args.verify:
+    print(f'{args.verify} matches pylon: {verify_camera(args.verify)}')
+
+
+if __name__ == '__main__':
+  main()
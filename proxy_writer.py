@@ -0,0 +1,128 @@
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+from scheduling import apply_role
+
+# Proxies are small review copies of each segment: every decimation-th frame, downsampled, as a low frame rate video,
+# plus a strip of thumbnails spread evenly over the segment. They're made from the frames the grab loop already has, so
+# nothing is decoded again. The grab loop only takes a strided copy of one frame in `decimation`, and hands it over
+# without ever waiting; if the encoder falls behind, proxy frames are skipped rather than slowing down the recording.
+
+
+class ProxyWorker:
+  def __init__(self, frame_rate, decimation=10, downsample=4, thumbnails=8, thumbnail_width=160, bit_depth=8,
+               fourcc=None, max_pending=8):
+    self.frame_rate = frame_rate / decimation
+    self.decimation = decimation
+    self.downsample = downsample
+    self.thumbnail_count = thumbnails
+    self.thumbnail_width = thumbnail_width
+    self.bit_depth = bit_depth
+    self.fourcc = fourcc or cv2.VideoWriter_fourcc(*'XVID')
+    self.max_pending = max_pending
+    self.dropped = 0
+
+    # Frames and segment boundaries go through the same queue, so they stay in order; only frames are ever dropped
+    self.queue = queue.Queue()
+    self.segments = {}
+    self.thread = threading.Thread(target=self.run, name='proxy-writer', daemon=True)
+
+  def start(self):
+    self.thread.start()
+
+  def stop(self):
+    self.queue.put(None)
+    self.thread.join()
+
+  def start_segment(self, key, video_path, thumbnail_path):
+    self.queue.put(('start', key, video_path, thumbnail_path))
+
+  def finish_segment(self, key):
+    self.queue.put(('finish', key))
+
+  def submit(self, key, index, frame):
+    if index % self.decimation:
+      return
+
+    if self.queue.qsize() >= self.max_pending:
+      self.dropped += 1
+      return
+
+    self.queue.put(('frame', key, np.ascontiguousarray(frame[::self.downsample, ::self.downsample])))
+
+  def run(self):
+    apply_role('worker')
+    while True:
+      item = self.queue.get()
+      if item is None:
+        for key in list(self.segments):
+          self.finish(key)
+        return
+
+      if item[0] == 'start':
+        _, key, video_path, thumbnail_path = item
+        if key in self.segments:
+          self.finish(key)
+        self.segments[key] = ProxySegment(video_path, thumbnail_path, self.thumbnail_count)
+      elif item[0] == 'finish':
+        self.finish(item[1])
+      else:
+        _, key, small = item
+        segment = self.segments.get(key)
+        if segment:
+          segment.add(self.to_bgr8(small), self.fourcc, self.frame_rate)
+
+  def finish(self, key):
+    segment = self.segments.pop(key, None)
+    if segment:
+      segment.close(self.thumbnail_width)
+
+  def to_bgr8(self, small):
+    # Unpacked 10/12-bit frames are scaled down to 8 bits; the video codecs only take 8-bit BGR
+    if small.dtype != np.uint8:
+      small = (small >> (self.bit_depth - 8)).astype(np.uint8)
+    if small.ndim == 2:
+      small = cv2.cvtColor(small, cv2.COLOR_GRAY2BGR)
+    return small
+
+
+class ProxySegment:
+  def __init__(self, video_path, thumbnail_path, thumbnail_count):
+    self.video_path = video_path
+    self.thumbnail_path = thumbnail_path
+    self.thumbnail_count = thumbnail_count
+    self.video_writer = None
+
+    # The segment's length isn't known until it's finished, so keep every stride-th frame and, whenever that's twice as
+    # many as needed, drop every other one and double the stride. What's left is spread evenly over the segment.
+    self.candidates = []
+    self.stride = 1
+    self.count = 0
+
+  def add(self, frame, fourcc, frame_rate):
+    if self.video_writer is None:
+      self.video_writer = cv2.VideoWriter(self.video_path, fourcc, frame_rate, (frame.shape[1], frame.shape[0]))
+    self.video_writer.write(frame)
+
+    if self.count % self.stride == 0:
+      self.candidates.append(frame)
+      if len(self.candidates) >= 2 * self.thumbnail_count:
+        self.candidates = self.candidates[::2]
+        self.stride *= 2
+    self.count += 1
+
+  def close(self, thumbnail_width):
+    if self.video_writer is None:
+      return
+
+    self.video_writer.release()
+
+    step = max(1, len(self.candidates) // self.thumbnail_count)
+    thumbnails = []
+    for frame in self.candidates[::step][:self.thumbnail_count]:
+      height = round(frame.shape[0] * thumbnail_width / frame.shape[1])
+      thumbnails.append(cv2.resize(frame, (thumbnail_width, height), interpolation=cv2.INTER_AREA))
+    cv2.imwrite(self.thumbnail_path, np.hstack(thumbnails))
@@ -0,0 +1,139 @@
+import time
+
+_started = time.perf_counter()
+
+import argparse
+import os
+
+from devices import DEFAULT_DEVICE_MAP, discover_devices, load_device_map, save_device_map
+from scheduling import add_arguments as add_scheduling_arguments, policy_from_args
+from segment_writers import add_arguments as add_writer_arguments, options_from_args
+from rig_config import DEFAULT_RIG_CONFIG, load_rig
+
+# This is the installed entry point (`pylon-recorder`). Only the argument parsing and the device map are imported up
+# front; pypylon, OpenCV and numpy are pulled in by the command that actually needs them, so `--help` and `devices` are
+# instant and a recording starts grabbing as soon as the cameras are configured.
+
+PIXEL_FORMAT_HELP = 'Record packed 10/12-bit frames, unpacked to 16-bit on the host (requires --format hdf5)'
+PROXY_HELP = "Don't write low-resolution proxy videos and thumbnail strips next to each segment"
+FORMAT_HELP = 'avi: AVI + CSV; mkv: crash-safe MKV with streamed metadata; hdf5: compressed frames and metadata in one file'
+BUS_PREFIX_HELP = 'Frame bus ring name prefix (rings are <prefix>_<camera>); use a different one for each recorder on a PC'
+
+
+def run_devices(args):
+  device_map = load_device_map(args.device_map)
+
+  if args.assign:
+    for assignment in args.assign:
+      name, serial = assignment.split('=', 1)
+      device_map[name] = {'serial': serial}
+
+  # Enumerating is the slow path, so only do it when asked to or when an assignment needs the device class filled in
+  if args.scan or any('device_class' not in entry for entry in device_map.values()):
+    devices = discover_devices()
+    by_serial = {device['serial']: device for device in devices}
+
+    for name, entry in device_map.items():
+      if entry['serial'] in by_serial:
+        entry.update(by_serial[entry['serial']])
+      else:
+        print(f'Warning: camera {name} (serial {entry["serial"]}) is not connected')
+
+    named = {entry['serial'] for entry in device_map.values()}
+    for device in devices:
+      if device['serial'] not in named:
+        print(f'Unassigned: {device["model"]} serial {device["serial"]}')
+
+  save_device_map(device_map, args.device_map)
+  for name, entry in sorted(device_map.items()):
+    print(f'{name}: {entry.get("model", "?")} serial {entry["serial"]}')
+
+
+def run_single(args):
+  from single_camera import Context
+  from frame_bus import FrameBus
+  from segment_writers import SEGMENT_WRITERS
+
+  policy_from_args(args)
+  context = Context(
+    frame_bus=FrameBus(args.bus_prefix) if args.publish_frames else None,
+    device_map=load_device_map(args.device_map),
+    segment_writer=SEGMENT_WRITERS[args.format],
+    segment_options=options_from_args(args),
+    pixel_format=args.pixel_format,
+    proxies=not args.no_proxies,
+    rig=load_rig(args.rig)
+  )
+  print(f'Ready to grab {time.perf_counter() - _started:.2f}s after launch')
+  context.run_loop()
+
+
+def run_multi(args):
+  if args.emulate:
+    os.environ['PYLON_CAMEMU'] = str(len(args.cameras))
+
+  from multi_camera import Context
+  from frame_bus import FrameBus
+  from segment_writers import SEGMENT_WRITERS
+
+  policy_from_args(args)
+  context = Context(
+    camera_names=args.cameras,
+    output_root=args.output,
+    emulated=args.emulate,
+    frame_bus=FrameBus(args.bus_prefix) if args.publish_frames else None,
+    device_map=None if args.emulate else load_device_map(args.device_map),
+    segment_writer=SEGMENT_WRITERS[args.format],
+    segment_options=options_from_args(args),
+    tiled=args.tiled,
+    pixel_format=args.pixel_format,
+    proxies=not args.no_proxies,
+    rig=load_rig(args.rig)
+  )
+  print(f'Ready to grab {time.perf_counter() - _started:.2f}s after launch')
+  context.run_loop()
+
+
+def main():
+  parser = argparse.ArgumentParser(prog='pylon-recorder', description='Record beam-triggered videos from Basler cameras')
+  parser.add_argument('--device-map', default=DEFAULT_DEVICE_MAP, help='Camera name to serial number mapping')
+  parser.add_argument('--rig', default=DEFAULT_RIG_CONFIG, help='Rig description with per-camera settings (rig_config.py)')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  devices_parser = commands.add_parser('devices', help='Show or update the camera name to serial number mapping')
+  devices_parser.add_argument('--assign', nargs='+', metavar='NAME=SERIAL', help='e.g. camA=40123456')
+  devices_parser.add_argument('--scan', action='store_true', help='Enumerate connected cameras and refresh the mapping')
+
+  single_parser = commands.add_parser('single', help='Record from camA')
+  single_parser.add_argument('--publish-frames', action='store_true', help='Publish frames on the shared-memory frame bus')
+  single_parser.add_argument('--bus-prefix', default='pylon', help=BUS_PREFIX_HELP)
+  single_parser.add_argument('--format', choices=['avi', 'mkv', 'hdf5'], default='avi', help=FORMAT_HELP)
+  add_writer_arguments(single_parser)
+  single_parser.add_argument('--pixel-format', choices=['Mono10p', 'Mono12p'], help=PIXEL_FORMAT_HELP)
+  single_parser.add_argument('--no-proxies', action='store_true', help=PROXY_HELP)
+  add_scheduling_arguments(single_parser)
+
+  multi_parser = commands.add_parser('multi', help='Record from several synchronized cameras')
+  multi_parser.add_argument('--cameras', nargs='+', default=['camA', 'camB', 'camC', 'camD'])
+  multi_parser.add_argument('--output', help='Recording directory')
+  multi_parser.add_argument('--emulate', action='store_true', help='Use pylon camera emulation instead of real cameras')
+  multi_parser.add_argument('--publish-frames', action='store_true', help='Publish frames on the shared-memory frame bus')
+  multi_parser.add_argument('--bus-prefix', default='pylon', help=BUS_PREFIX_HELP)
+  multi_parser.add_argument('--format', choices=['avi', 'mkv', 'hdf5'], default='avi', help=FORMAT_HELP)
+  add_writer_arguments(multi_parser)
+  multi_parser.add_argument('--pixel-format', choices=['Mono10p', 'Mono12p'], help=PIXEL_FORMAT_HELP)
+  multi_parser.add_argument('--tiled', action='store_true', help='Encode all cameras as one tiled video per segment')
+  multi_parser.add_argument('--no-proxies', action='store_true', help=PROXY_HELP)
+  add_scheduling_arguments(multi_parser)
+
+  args = parser.parse_args()
+  if args.command == 'devices':
+    run_devices(args)
+  elif args.command == 'single':
+    run_single(args)
+  else:
+    run_multi(args)
+
+
+if __name__ == '__main__':
+  main()
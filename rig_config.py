@@ -0,0 +1,366 @@
+import argparse
+import collections
+import copy
+import json
+import math
+import os
+import time
+
+from devices import DEFAULT_DEVICE_MAP
+
+# The rig is described once, as data: which camera (by serial) has which chunks, counters, ROI, exposure, frame rate and
+# trigger lines. compile_plan() turns one camera's settings into an ordered list of node writes, and apply_plan() walks
+# that list against a live camera, reading each node first and writing only the ones that differ. A camera that still
+# has the previous session's configuration is ready after a few reads instead of a full UserSetLoad and rewrite.
+#
+# A rig file is JSON with per-camera entries on top of shared defaults, e.g.
+#   {"defaults": {"exposure_us": 2500},
+#    "cameras": {"camA": {"serial": "40123456"}, "camB": {"serial": "40123457", "roi": {"offset_x": 16}}}}
+# Anything not given falls back to DEFAULT_SETTINGS, which is the configuration the recording scripts have always used.
+DEFAULT_RIG_CONFIG = os.path.join(os.path.dirname(DEFAULT_DEVICE_MAP), 'rig.json')
+
+# Since the user set isn't reloaded on every start, anything left out of the plan keeps whatever the last session set.
+# So settings a session may override, like the ROI offsets, have a concrete default here. The pixel format is the
+# exception: None keeps the user set's own format (BayerRG8 on the acA1440-220uc color cameras), and apply_plan()
+# restores it when a previous session's --pixel-format is still on the camera.
+DEFAULT_SETTINGS = {
+  # Only loaded with apply_plan(reset=True); cameras load their startup set (normally Default) when they power up
+  'user_set': 'Default',
+  'chunks': ['LineStatusAll', 'Timestamp', 'CounterValue'],
+  'counters': {'Counter1': 'FrameStart'},
+  'roi': {'width': 800, 'height': 600, 'offset_x': 0, 'offset_y': 0},
+  'pixel_format': None,
+  'exposure_us': 3000,
+  'frame_rate': 200.0,
+  'gain_auto': 'Continuous',
+  # None leaves the camera free running
+  'trigger': {'selector': 'FrameStart', 'source': 'Line3', 'activation': 'RisingEdge'},
+  # e.g. {"Line2": {"mode": "Output", "source": "UserOutput1"}}
+  'lines': {},
+}
+
+# Nodes that have to be written before the given node: pixel format and ROI change which frame rates are possible,
+# offsets are only valid once the size is known, and a trigger is switched on only after its source is set
+DEPENDENCIES = {
+  'Width': ['PixelFormat'],
+  'Height': ['PixelFormat'],
+  'OffsetX': ['Width'],
+  'OffsetY': ['Height'],
+  'AcquisitionFrameRate': ['AcquisitionFrameRateEnable', 'ExposureTime', 'PixelFormat', 'Width', 'Height'],
+  'ChunkEnable': ['ChunkModeActive'],
+  'LineSource': ['LineMode'],
+  'TriggerMode': ['TriggerSource', 'TriggerActivation', 'LineMode', 'LineSource'],
+}
+
+# Growing the ROI fails while an offset would push it past the sensor edge
+OFFSET_FOR = {'Width': 'OffsetX', 'Height': 'OffsetY'}
+
+Step = collections.namedtuple('Step', ['node', 'value', 'selectors'])
+
+
+class PlanResult:
+  def __init__(self):
+    self.writes = []
+    self.selections = 0
+    self.unchanged = 0
+    self.unavailable = []
+    self.mismatches = []
+    self.errors = []
+    self.seconds = 0.0
+
+  def summary(self):
+    return (f'{len(self.writes)} writes, {self.unchanged} already set, {len(self.unavailable)} unavailable, '
+            f'{len(self.errors)} errors in {self.seconds * 1000:.1f} ms')
+
+
+class RigConfig:
+  def __init__(self, description=None):
+    self.description = description or {}
+
+  def camera_names(self):
+    return list(self.description.get('cameras', {}))
+
+  def settings(self, name):
+    """DEFAULT_SETTINGS, overridden by the rig's defaults and then by the camera's own entry."""
+    settings = copy.deepcopy(DEFAULT_SETTINGS)
+    for layer in (self.description.get('defaults', {}), self.description.get('cameras', {}).get(name, {})):
+      for key, value in layer.items():
+        # Dicts like roi and trigger are merged one level deep, so a camera can override just an offset
+        if isinstance(value, dict) and isinstance(settings.get(key), dict):
+          settings[key].update(copy.deepcopy(value))
+        else:
+          settings[key] = copy.deepcopy(value)
+    return settings
+
+  def device_map(self):
+    """Serial numbers from the rig, in the same form as devices.load_device_map()."""
+    return {
+      name: {key: entry[key] for key in ('serial', 'device_class') if key in entry}
+      for name, entry in self.description.get('cameras', {}).items() if 'serial' in entry
+    }
+
+
+def load_rig(path=DEFAULT_RIG_CONFIG):
+  if not path or not os.path.exists(path):
+    return RigConfig()
+
+  with open(path) as f:
+    return RigConfig(json.load(f))
+
+
+def emulated_settings(settings):
+  """The part of a camera's settings that pylon camera emulation has: size, pixel format and a free-running frame rate."""
+  return dict(
+    settings,
+    chunks=None,
+    counters={},
+    exposure_us=None,
+    gain_auto=None,
+    trigger=None,
+    lines={}
+  )
+
+
+def compile_plan(settings):
+  """Turn one camera's settings into Steps, ordered so every node comes after the nodes it depends on."""
+  steps = []
+
+  if settings.get('pixel_format'):
+    steps.append(Step('PixelFormat', settings['pixel_format'], ()))
+
+  roi = settings.get('roi') or {}
+  for key, node in (('width', 'Width'), ('height', 'Height'), ('offset_x', 'OffsetX'), ('offset_y', 'OffsetY')):
+    if roi.get(key) is not None:
+      steps.append(Step(node, roi[key], ()))
+
+  if settings.get('exposure_us') is not None:
+    steps.append(Step('ExposureTime', float(settings['exposure_us']), ()))
+
+  if settings.get('frame_rate') is not None:
+    steps.append(Step('AcquisitionFrameRateEnable', bool(settings['frame_rate']), ()))
+    if settings['frame_rate']:
+      steps.append(Step('AcquisitionFrameRate', float(settings['frame_rate']), ()))
+
+  if settings.get('gain_auto'):
+    steps.append(Step('GainAuto', settings['gain_auto'], ()))
+
+  # chunks=None leaves chunk mode alone, an empty list switches it off
+  if settings.get('chunks') is not None:
+    steps.append(Step('ChunkModeActive', bool(settings['chunks']), ()))
+    for chunk in settings['chunks']:
+      steps.append(Step('ChunkEnable', True, (('ChunkSelector', chunk),)))
+
+  for counter, event_source in (settings.get('counters') or {}).items():
+    steps.append(Step('CounterEventSource', event_source, (('CounterSelector', counter),)))
+
+  for line, line_settings in (settings.get('lines') or {}).items():
+    if line_settings.get('mode'):
+      steps.append(Step('LineMode', line_settings['mode'], (('LineSelector', line),)))
+    if line_settings.get('source'):
+      steps.append(Step('LineSource', line_settings['source'], (('LineSelector', line),)))
+
+  trigger = settings.get('trigger')
+  if trigger:
+    selector = (('TriggerSelector', trigger.get('selector', 'FrameStart')),)
+    steps.append(Step('TriggerSource', trigger['source'], selector))
+    if trigger.get('activation'):
+      steps.append(Step('TriggerActivation', trigger['activation'], selector))
+    steps.append(Step('TriggerMode', 'On', selector))
+  elif 'trigger' in settings:
+    steps.append(Step('TriggerMode', 'Off', (('TriggerSelector', 'FrameStart'),)))
+
+  return order_steps(steps)
+
+
+def order_steps(steps):
+  # Stable topological sort: a step is taken as soon as nothing it depends on is still waiting, otherwise declaration
+  # order is kept
+  remaining = list(steps)
+  ordered = []
+  while remaining:
+    waiting = {step.node for step in remaining}
+    for i, step in enumerate(remaining):
+      if not waiting.intersection(DEPENDENCIES.get(step.node, ())):
+        ordered.append(remaining.pop(i))
+        break
+    else:
+      raise ValueError(f'Circular dependency between {sorted(waiting)}')
+
+  return ordered
+
+
+def same_value(current, value):
+  if isinstance(value, float):
+    return math.isclose(current, value, rel_tol=1e-3)
+  return current == value
+
+
+def apply_plan(camera, plan, reset=False, user_set='Default', skip_unavailable=False, strict=True):
+  """Bring camera to the state described by plan, writing only nodes whose current value differs.
+
+  A plan without a PixelFormat step means the user set's format. If the camera has one of the packed formats instead,
+  which only a --pixel-format override puts there, the user set is loaded first to get that format back.
+
+  With skip_unavailable, nodes the camera doesn't have (e.g. chunks under camera emulation) are listed in the result
+  instead of failing. With strict=False, failed writes are collected in result.errors rather than raised.
+  """
+  from pypylon import genicam
+  from packed_formats import PACKED_FORMATS
+
+  result = PlanResult()
+  start = time.perf_counter()
+  nodemap = camera.GetNodeMap()
+
+  if not reset and not any(step.node == 'PixelFormat' for step in plan):
+    node = nodemap.GetNode('PixelFormat')
+    reset = node is not None and genicam.IsReadable(node) and node.GetValue() in PACKED_FORMATS
+
+  if reset:
+    camera.UserSetSelector.SetValue(user_set)
+    camera.UserSetLoad.Execute()
+    result.writes.append(('UserSetLoad', (), None, user_set))
+
+  # Selector values are remembered so a selector shared by several steps is only read once
+  selected = {}
+
+  def write(name, value, selectors=(), selector=False):
+    node = nodemap.GetNode(name)
+    if node is None or not genicam.IsAvailable(node):
+      if not skip_unavailable:
+        raise RuntimeError(f'Camera has no node {name}')
+      result.unavailable.append((name, selectors))
+      return
+
+    current = node.GetValue() if genicam.IsReadable(node) else None
+    if current is not None and same_value(current, value):
+      if not selector:
+        result.unchanged += 1
+      return
+
+    if name in OFFSET_FOR and value > node.GetMax():
+      write(OFFSET_FOR[name], 0)
+
+    try:
+      node.SetValue(value)
+    except genicam.GenericException as e:
+      if strict:
+        raise
+      result.errors.append((name, selectors, value, str(e)))
+      return
+
+    # Selectors only choose which chunk/counter/line the next write goes to; they aren't configuration themselves
+    if selector:
+      result.selections += 1
+      return
+
+    result.writes.append((name, selectors, current, value))
+
+    # Some writes are accepted but don't take, e.g. a chunk the camera doesn't support
+    if genicam.IsReadable(node) and not same_value(node.GetValue(), value):
+      result.mismatches.append((name, selectors, value, node.GetValue()))
+
+  for step in plan:
+    for selector, selector_value in step.selectors:
+      if selected.get(selector) != selector_value:
+        write(selector, selector_value, selector=True)
+        selected[selector] = selector_value
+
+    write(step.node, step.value, step.selectors)
+
+  result.seconds = time.perf_counter() - start
+  return result
+
+
+def describe(plan):
+  return [
+    ''.join(f'{selector}={value} ' for selector, value in step.selectors) + f'{step.node} = {step.value}'
+    for step in plan
+  ]
+
+
+def validate(rig, names=None):
+  """Apply every camera's plan to an emulated camera twice, without any hardware attached.
+
+  The first pass (after a user set reset) catches nodes and values the camera model doesn't accept; the second must find
+  nothing left to write, which shows the plan is consistent and that reconfiguring an already configured camera only
+  reads. Nodes that emulation doesn't have are reported, not treated as errors.
+  """
+  os.environ.setdefault('PYLON_CAMEMU', '1')
+  from pypylon import pylon
+
+  camera = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
+  camera.Open()
+  report = {}
+  try:
+    for name in names or rig.camera_names() or ['camA']:
+      settings = rig.settings(name)
+      plan = compile_plan(settings)
+      first = apply_plan(camera, plan, reset=True, user_set=settings['user_set'], skip_unavailable=True, strict=False)
+      second = apply_plan(camera, plan, skip_unavailable=True, strict=False)
+      report[name] = {
+        'steps': len(plan),
+        'first_pass': first.summary(),
+        'second_pass': second.summary(),
+        'unavailable_in_emulation': sorted({node for node, _ in first.unavailable}),
+        'errors': [f'{node} = {value}: {error}' for node, _, value, error in first.errors],
+        'mismatches': [f'{node}: wrote {value}, reads {actual}' for node, _, value, actual in first.mismatches],
+        'ok': not first.errors and not second.writes and not second.errors,
+      }
+  finally:
+    camera.Close()
+
+  return report
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Show, validate or apply the declarative rig configuration')
+  parser.add_argument('rig', nargs='?', default=DEFAULT_RIG_CONFIG, help='Rig description (JSON)')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  plan_parser = commands.add_parser('plan', help='Print the ordered write plan for each camera')
+  plan_parser.add_argument('--cameras', nargs='+')
+
+  validate_parser = commands.add_parser('validate', help='Check the plans against an emulated camera')
+  validate_parser.add_argument('--cameras', nargs='+')
+
+  apply_parser = commands.add_parser('apply', help='Configure the connected cameras, by serial number')
+  apply_parser.add_argument('--cameras', nargs='+')
+  apply_parser.add_argument('--reset', action='store_true', help='Load the user set first and rewrite everything')
+  apply_parser.add_argument('--device-map', default=DEFAULT_DEVICE_MAP,
+                            help='Camera name to serial number mapping, for cameras the rig gives no serial')
+
+  args = parser.parse_args()
+  rig = load_rig(args.rig)
+  names = args.cameras or rig.camera_names() or ['camA']
+
+  if args.command == 'plan':
+    for name in names:
+      print(f'{name}:')
+      for line in describe(compile_plan(rig.settings(name))):
+        print(f'  {line}')
+
+  elif args.command == 'validate':
+    report = validate(rig, names)
+    print(json.dumps(report, indent=2))
+    if not all(entry['ok'] for entry in report.values()):
+      raise SystemExit(1)
+
+  else:
+    from pypylon import pylon
+    from devices import create_device, load_device_map, merge_device_maps
+
+    tlf = pylon.TlFactory.GetInstance()
+    device_map = merge_device_maps(load_device_map(args.device_map), rig.device_map())
+    for name in names:
+      camera = pylon.InstantCamera(create_device(tlf, name, device_map))
+      camera.Open()
+      try:
+        settings = rig.settings(name)
+        result = apply_plan(camera, compile_plan(settings), reset=args.reset, user_set=settings['user_set'])
+        print(f'{name}: {result.summary()}')
+      finally:
+        camera.Close()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,191 @@
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+
+# CPU placement for the acquisition threads. Every thread we start says which role it has when it starts running
+# (apply_role), and the process-wide policy pins it to that role's CPUs:
+#   grab:    the run_loop threads, and the pylon transport threads they start (threads inherit their creator's CPUs)
+#   encoder: the per-camera AVI/Matroska encoders, tiled encoder, HDF5 compression pool
+#   worker:  quality metrics, camera events, fsync, proxies
+# The grab role can additionally run under SCHED_FIFO, which needs CAP_SYS_NICE (or an rtprio limit). For flat latency
+# under load, the grab CPUs should also be kept free of everything else, e.g. with isolcpus= or a cpuset; pinning only
+# decides where our own threads run. On platforms without sched_setaffinity (Windows, macOS) the policy does nothing.
+
+ROLES = ('grab', 'encoder', 'worker')
+
+_policy = None
+
+
+def parse_cpus(text):
+  """'2,3,8-11' -> {2, 3, 8, 9, 10, 11}"""
+  cpus = set()
+  for part in text.split(','):
+    first, _, last = part.partition('-')
+    cpus.update(range(int(first), int(last or first) + 1))
+  return cpus
+
+
+class SchedulingPolicy:
+  def __init__(self, cpus=None, realtime_priority=None, worker_nice=None):
+    self.cpus = cpus or {}
+    self.realtime_priority = realtime_priority
+    self.worker_nice = worker_nice
+
+    # (thread name, native id, role, what was applied) for every thread that picked up the policy
+    self.applied = []
+    self.lock = threading.Lock()
+
+  def cpus_for(self, role):
+    if self.cpus.get(role):
+      return self.cpus[role]
+
+    # Most workers are started from the grab thread and would inherit its CPUs, so roles without CPUs of their own get
+    # everything but the grab CPUs instead
+    if role != 'grab' and self.cpus.get('grab'):
+      return set(range(os.cpu_count())) - self.cpus['grab'] or None
+
+    return None
+
+  def apply(self, role):
+    """Apply role's settings to the calling thread."""
+    if not hasattr(os, 'sched_setaffinity'):
+      return
+
+    settings = []
+
+    # On Linux, pid 0 means the calling thread rather than the whole process
+    cpus = self.cpus_for(role)
+    if cpus:
+      os.sched_setaffinity(0, cpus)
+      settings.append(f'cpus={",".join(map(str, sorted(cpus)))}')
+
+    try:
+      if role == 'grab' and self.realtime_priority:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.realtime_priority))
+        settings.append(f'SCHED_FIFO {self.realtime_priority}')
+      elif self.realtime_priority:
+        # The scheduling class is inherited too; a worker must not run ahead of everything else on its CPUs
+        os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+
+      if role != 'grab' and self.worker_nice is not None:
+        # Unlike nice(), setpriority with a thread id only affects that thread
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.worker_nice)
+        settings.append(f'nice={self.worker_nice}')
+    except PermissionError:
+      settings.append('priority not permitted')
+
+    with self.lock:
+      self.applied.append((threading.current_thread().name, threading.get_native_id(), role, ', '.join(settings)))
+
+  def report(self):
+    with self.lock:
+      return [
+        f'{name} (tid {native_id}): {role}, {settings or "unchanged"}'
+        for name, native_id, role, settings in self.applied
+      ]
+
+
+def set_policy(policy):
+  global _policy
+  _policy = policy
+
+
+def apply_role(role):
+  """Called by every acquisition thread as it starts; does nothing unless a policy has been set."""
+  if _policy:
+    _policy.apply(role)
+
+
+def add_arguments(parser):
+  parser.add_argument('--grab-cpus', type=parse_cpus, help='CPUs for the grab threads, e.g. 2,3')
+  parser.add_argument('--encoder-cpus', type=parse_cpus, help='CPUs for encoder threads, e.g. 4-7')
+  parser.add_argument('--worker-cpus', type=parse_cpus, help='CPUs for background workers, e.g. 0,1')
+  parser.add_argument('--realtime-priority', type=int, help='Run grab threads under SCHED_FIFO at this priority (1-99)')
+  parser.add_argument('--worker-nice', type=int, help='Nice value for encoder and worker threads')
+
+
+def policy_from_args(args):
+  """Build and install a policy from add_arguments() flags. Returns None if none of them were given."""
+  cpus = {role: getattr(args, f'{role}_cpus') for role in ROLES if getattr(args, f'{role}_cpus')}
+  if not cpus and args.realtime_priority is None and args.worker_nice is None:
+    return None
+
+  policy = SchedulingPolicy(cpus, args.realtime_priority, args.worker_nice)
+  set_policy(policy)
+  return policy
+
+
+def measure_jitter(role, duration=5.0, period=0.001):
+  """Apply role's settings to the calling thread, then sleep for period over and over and return how late the wakeups
+  were, in microseconds.
+
+  This is the delay a thread in the same place sees before it gets to run, e.g. the grab thread after a frame arrives.
+  """
+  import numpy as np
+
+  apply_role(role)
+
+  lateness = []
+  end = time.perf_counter() + duration
+  while time.perf_counter() < end:
+    before = time.perf_counter_ns()
+    time.sleep(period)
+    lateness.append(time.perf_counter_ns() - before - period * 1e9)
+
+  lateness = np.array(lateness) / 1000
+  return {
+    'p50_us': float(np.percentile(lateness, 50)),
+    'p99_us': float(np.percentile(lateness, 99)),
+    'p999_us': float(np.percentile(lateness, 99.9)),
+    'max_us': float(lateness.max()),
+  }
+
+
+def spin(end):
+  while time.time() < end:
+    pass
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Measure scheduling jitter of each role under a CPU placement policy')
+  add_arguments(parser)
+  parser.add_argument('--duration', type=float, default=5.0)
+  parser.add_argument('--load', type=int, default=0, help='Busy-loop processes to run alongside, to simulate load')
+  args = parser.parse_args()
+
+  policy = policy_from_args(args)
+
+  load = [
+    multiprocessing.Process(target=spin, args=(time.time() + args.duration + 1,), daemon=True)
+    for _ in range(args.load)
+  ]
+  for process in load:
+    process.start()
+
+  results = {}
+
+  def run(role):
+    results[role] = measure_jitter(role, args.duration)
+
+  probes = [threading.Thread(target=run, args=(role,), name=f'jitter-{role}') for role in ROLES]
+  for probe in probes:
+    probe.start()
+  for probe in probes:
+    probe.join()
+
+  for role in ROLES:
+    stats = results[role]
+    print(f'{role:8} wakeup lateness p50 {stats["p50_us"]:.0f}us  p99 {stats["p99_us"]:.0f}us  '
+          f'p99.9 {stats["p999_us"]:.0f}us  max {stats["max_us"]:.0f}us')
+
+  if policy:
+    print('\n'.join(policy.report()))
+
+  for process in load:
+    process.terminate()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,369 @@
+import collections
+import csv
+import os
+import queue
+import threading
+import time
+import zlib
+
+from metadata_log import METADATA_COLUMNS, write_metadata
+from scheduling import apply_role
+
+# A segment writer owns the files for one camera's segment. The Context classes create one per camera when a segment
+# starts, call write() for every frame, and close() when the segment is finished. The rows passed to close() are the
+# same ones given to write(), with per-frame columns that were only computed afterwards (e.g. quality metrics).
+#
+# high_bit_depth says whether a writer can store uint16 frames (unpacked Mono10p/Mono12p, see packed_formats.py) as they
+# are. The video codecs are 8-bit only, so the Context classes refuse packed pixel formats with those writers.
+#
+# The video codecs are CPU-heavy, so the AVI and Matroska writers encode on an EncoderThread of their own (scheduling role
+# 'encoder') and write() only queues the frame; the grab thread never runs the codec.
+#
+# stats is None, or a dict of numbers about the finished segment (set by close()) that the Context classes log.
+#
+# Options specific to one writer (e.g. DurableSegmentWriter's flush budget) are keyword arguments of its constructor. The
+# Context classes pass their segment_options through to every writer they create; add_arguments() and
+# options_from_args() are the command line side of it. OpenCV and numpy are only imported by the writers themselves, so
+# the command line tools can use those without loading them.
+
+
+class EncoderThread:
+  """Calls encode(frame, metadata) for every queued frame on its own thread, in order.
+
+  The queue is bounded: if encoding falls max_pending frames behind, put() waits, as the grab loop did when it encoded
+  itself. A failure in encode() is raised from the next put(), or from close().
+  """
+
+  def __init__(self, encode, name, max_pending=16):
+    self.encode = encode
+    self.error = None
+    self.queue = queue.Queue(maxsize=max_pending)
+    self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+    self.thread.start()
+
+  def put(self, frame, metadata):
+    if self.error:
+      raise self.error
+    self.queue.put((frame, metadata))
+
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
+    if self.error:
+      raise self.error
+
+  def run(self):
+    apply_role('encoder')
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+
+      # After a failure keep taking frames off the queue, so put() and close() can't block on a dead thread
+      if self.error is None:
+        try:
+          self.encode(*item)
+        except Exception as e:
+          self.error = e
+
+
+class AviSegmentWriter:
+  """One AVI per segment, with its metadata CSV written when the segment is finished.
+
+  Fast, but nothing about the segment is readable until it's closed: a crash loses the AVI index and all of the metadata.
+  """
+
+  extension = '.avi'
+  high_bit_depth = False
+  stats = None
+
+  def __init__(self, video_path, metadata_path, fourcc, frame_rate, resolution, max_pending=16):
+    import cv2
+
+    self.video_path = video_path
+    self.metadata_path = metadata_path
+    self.video_writer = cv2.VideoWriter(video_path, fourcc, frame_rate, resolution)
+    self.encoder = EncoderThread(self.encode, 'avi-encoder', max_pending)
+
+  def write(self, frame, metadata):
+    self.encoder.put(frame, metadata)
+
+  def encode(self, frame, metadata):
+    self.video_writer.write(frame)
+
+  def close(self, metadata, extra_columns=None):
+    try:
+      self.encoder.close()
+    finally:
+      self.video_writer.release()
+    write_metadata(self.metadata_path, metadata, extra_columns)
+
+
+class DurableSegmentWriter:
+  """Crash-safe segment: a Matroska video plus a metadata CSV that is appended to as frames arrive.
+
+  Unlike AVI, Matroska needs no index at the end of the file; everything written before a crash can still be decoded.
+  The metadata rows are written out as their frames are encoded. Both files are fsynced together by a background thread
+  whenever flush_interval seconds or flush_bytes bytes have accumulated since the last sync, so at most about one flush
+  interval of data (plus the frames still queued for the encoder) is at risk while the grab loop never waits on the disk. What durability cost is in `stats` once it's closed:
+  the number of syncs, the time spent in them, and that time as a fraction of how long the segment was open.
+  """
+
+  extension = '.mkv'
+  high_bit_depth = False
+  stats = None
+
+  def __init__(self, video_path, metadata_path, fourcc, frame_rate, resolution, flush_interval=0.25,
+               flush_bytes=16 * 1024 * 1024, max_pending=16):
+    import cv2
+
+    self.video_path = video_path
+    self.metadata_path = metadata_path
+    self.flush_interval = flush_interval
+    self.flush_bytes = flush_bytes
+
+    self.video_writer = cv2.VideoWriter(video_path, cv2.CAP_FFMPEG, fourcc, frame_rate, resolution)
+    self.metadata_file = open(metadata_path, 'w', newline='')
+    self.metadata_writer = csv.writer(self.metadata_file)
+    self.metadata_writer.writerow(METADATA_COLUMNS)
+
+    # A second descriptor on the video file; fsync works on the file, whichever descriptor it's called through
+    self.video_fd = os.open(video_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+    self.synced_size = 0
+    self.opened = self.last_sync = time.monotonic()
+    self.frame_count = 0
+
+    self.syncs = 0
+    self.sync_seconds = 0.0
+    self.sync_requested = threading.Event()
+    self.closing = False
+    self.sync_thread = threading.Thread(target=self.run_sync, name='segment-sync', daemon=True)
+    self.sync_thread.start()
+
+    # Rows are written along with their frames, on the encoder thread, so a synced row always has its frame on disk
+    self.encoder = EncoderThread(self.encode, 'mkv-encoder', max_pending)
+
+  def write(self, frame, metadata):
+    self.encoder.put(frame, metadata)
+
+  def encode(self, frame, metadata):
+    self.video_writer.write(frame)
+    self.metadata_writer.writerow(metadata)
+    self.frame_count += 1
+
+    now = time.monotonic()
+    pending = os.fstat(self.video_fd).st_size - self.synced_size
+    if now - self.last_sync >= self.flush_interval or pending >= self.flush_bytes:
+      # Hand the rows to the OS here, the fsync itself happens on the sync thread
+      self.metadata_file.flush()
+      self.synced_size += pending
+      self.last_sync = now
+      self.sync_requested.set()
+
+  def run_sync(self):
+    apply_role('worker')
+    while True:
+      self.sync_requested.wait()
+      self.sync_requested.clear()
+
+      # Read before syncing: if close() comes in during this sync, it sets the event again and we go round once more
+      closing = self.closing
+
+      start = time.perf_counter()
+      os.fsync(self.metadata_file.fileno())
+      os.fsync(self.video_fd)
+      self.sync_seconds += time.perf_counter() - start
+      self.syncs += 1
+
+      if closing:
+        return
+
+  def close(self, metadata, extra_columns=None):
+    try:
+      self.encoder.close()
+    finally:
+      self.video_writer.release()
+    self.metadata_file.flush()
+
+    self.closing = True
+    self.sync_requested.set()
+    self.sync_thread.join()
+
+    self.metadata_file.close()
+    os.close(self.video_fd)
+
+    open_seconds = time.monotonic() - self.opened
+    self.stats = {
+      'frames': self.frame_count,
+      'syncs': self.syncs,
+      'sync_seconds': self.sync_seconds,
+      'sync_fraction': self.sync_seconds / open_seconds if open_seconds > 0 else 0.0
+    }
+
+    # The streamed log already has every row; columns computed after the fact are added by rewriting it in one go, so a
+    # crash in between leaves the streamed log in place
+    if extra_columns:
+      temporary_path = self.metadata_path + '.tmp'
+      write_metadata(temporary_path, metadata, extra_columns)
+      os.replace(temporary_path, self.metadata_path)
+
+
+class Hdf5SegmentWriter:
+  """Frames and per-frame metadata together in one chunked, compressed HDF5 file, for pipelines that read arrays.
+
+  Each frame is its own chunk of the `frames` dataset, so any range of frames can be read back without decoding the rest
+  (see read_frames). Timestamp_ns, LineStatusAll and CounterValue are stored as aligned columns next to it.
+
+  With the default gzip compressor the frames are deflated by a pool of compression_threads threads (zlib releases the
+  GIL) and written with write_direct_chunk, so the file is readable by any HDF5 reader with no plugins. Any other
+  compression h5py accepts (e.g. 'lzf', or an hdf5plugin filter such as Blosc) goes through HDF5's own filter pipeline.
+  Frames are stored with whatever dtype they arrive in, so 10/12-bit frames keep their full depth as uint16. Requires
+  h5py.
+  """
+
+  extension = '.h5'
+  high_bit_depth = True
+  stats = None
+
+  def __init__(self, video_path, metadata_path, fourcc, frame_rate, resolution, compression='gzip', compression_level=1,
+               compression_threads=4, max_pending=64):
+    import h5py
+    from concurrent.futures import ThreadPoolExecutor
+
+    self.video_path = video_path
+    self.metadata_path = video_path
+    self.compression = compression
+    self.compression_level = compression_level
+    self.max_pending = max_pending
+
+    self.file = h5py.File(video_path, 'w')
+    self.file.attrs['frame_rate'] = frame_rate
+    self.frames = None
+    self.frame_count = 0
+
+    self.threaded = compression == 'gzip'
+    self.pool = ThreadPoolExecutor(max_workers=compression_threads, thread_name_prefix='hdf5-compress',
+                                   initializer=apply_role, initargs=('encoder',))
+    self.pending = collections.deque()
+
+  def create_frames(self, frame):
+    kwargs = {}
+    if self.compression == 'gzip':
+      kwargs['compression_opts'] = self.compression_level
+    if self.compression:
+      kwargs['compression'] = self.compression
+
+    self.frames = self.file.create_dataset(
+      'frames',
+      shape=(0,) + frame.shape,
+      maxshape=(None,) + frame.shape,
+      chunks=(1,) + frame.shape,
+      dtype=frame.dtype,
+      **kwargs
+    )
+
+  def write(self, frame, metadata):
+    if self.frames is None:
+      self.create_frames(frame)
+
+    index = self.frame_count
+    self.frame_count += 1
+
+    # Grow the dataset in steps rather than on every frame
+    if self.frame_count > self.frames.shape[0]:
+      self.frames.resize(self.frames.shape[0] + 256, axis=0)
+
+    if not self.threaded:
+      self.frames[index] = frame
+      return
+
+    if not frame.flags.c_contiguous:
+      frame = frame.copy()
+    self.pending.append((index, self.pool.submit(zlib.compress, frame, self.compression_level)))
+
+    # Chunks are written in order as their compression finishes; only block when compression falls far behind
+    while self.pending and (self.pending[0][1].done() or len(self.pending) > self.max_pending):
+      self.write_chunk(*self.pending.popleft())
+
+  def write_chunk(self, index, future):
+    self.frames.id.write_direct_chunk((index,) + (0,) * (self.frames.ndim - 1), future.result())
+
+  def close(self, metadata, extra_columns=None):
+    import numpy as np
+
+    while self.pending:
+      self.write_chunk(*self.pending.popleft())
+    self.pool.shutdown()
+
+    if self.frames is not None:
+      self.frames.resize(self.frame_count, axis=0)
+
+    columns = np.array(metadata, dtype=np.int64).reshape(-1, len(METADATA_COLUMNS))
+    for i, name in enumerate(METADATA_COLUMNS):
+      self.file.create_dataset(name, data=columns[:, i])
+
+    for name, values in (extra_columns or {}).items():
+      self.file.create_dataset(name, data=np.asarray(values))
+
+    self.file.close()
+
+
+def read_frames(path, start=0, stop=None):
+  """Read frames[start:stop] from a Hdf5SegmentWriter file; only the chunks in that range are decompressed."""
+  import h5py
+
+  with h5py.File(path, 'r') as f:
+    return f['frames'][start:stop]
+
+
+def read_segment_metadata(path, start=0, stop=None):
+  """Read the per-frame metadata columns of a Hdf5SegmentWriter file as a dict of arrays."""
+  import h5py
+
+  with h5py.File(path, 'r') as f:
+    return {name: f[name][start:stop] for name in f if name != 'frames'}
+
+
+SEGMENT_WRITERS = {
+  'avi': AviSegmentWriter,
+  'mkv': DurableSegmentWriter,
+  'hdf5': Hdf5SegmentWriter,
+}
+
+# Format -> the add_arguments() flags (as constructor keyword arguments) that apply to it
+WRITER_OPTIONS = {
+  'mkv': ('flush_interval', 'flush_bytes'),
+  'hdf5': ('compression', 'compression_level', 'compression_threads'),
+}
+
+
+def add_arguments(parser):
+  parser.add_argument('--flush-interval', type=float, help='mkv: fsync at least this often, in seconds (default 0.25)')
+  parser.add_argument('--flush-bytes', type=int, help='mkv: fsync at least every this many bytes (default 16 MiB)')
+  parser.add_argument('--compression', type=hdf5_compression,
+                      help='hdf5: gzip (default), lzf, none, or any other filter h5py accepts (e.g. from hdf5plugin)')
+  parser.add_argument('--compression-level', type=int, help='hdf5: gzip level, 0-9 (default 1)')
+  parser.add_argument('--compression-threads', type=int, help='hdf5: threads compressing gzip chunks (default 4)')
+
+
+def hdf5_compression(value):
+  # h5py takes None for uncompressed, and filter ids as integers
+  if value == 'none':
+    return False
+  return int(value) if value.isdigit() else value
+
+
+def options_from_args(args):
+  """Keyword arguments for SEGMENT_WRITERS[args.format] from add_arguments() flags; flags left out keep the defaults."""
+  options = {}
+  for names in WRITER_OPTIONS.values():
+    for name in names:
+      value = getattr(args, name)
+      if value is None:
+        continue
+      if name not in WRITER_OPTIONS.get(args.format, ()):
+        formats = [format for format, names in WRITER_OPTIONS.items() if name in names]
+        raise ValueError(f'--{name.replace("_", "-")} only applies to --format {" or ".join(formats)}')
+      options[name] = value
+
+  return options
@@ -0,0 +1,255 @@
+import argparse
+import csv
+import os
+import re
+import sqlite3
+
+from datetime import datetime
+from metadata_log import METADATA_COLUMNS
+
+# Segment labels are the wall clock time a video was started, e.g. 2025-06-01_14-03-22-123456
+SEGMENT_FORMAT = '%Y-%m-%d_%H-%M-%S-%f'
+VIDEO_PATTERN = re.compile(r'^(?P<camera>[^_]+)_(?P<segment>\d{4}-\d{2}-\d{2}_[\d-]+)\.(avi|mkv|h5)$')
+
+# Bumped whenever SCHEMA changes in a way CREATE ... IF NOT EXISTS can't apply to an existing catalog; see migrate()
+SCHEMA_VERSION = 1
+
+SEGMENTS_TABLE = """
+CREATE TABLE IF NOT EXISTS {name} (
+  id INTEGER PRIMARY KEY,
+  camera TEXT NOT NULL,
+  segment TEXT NOT NULL,
+  started_at TEXT,
+  video_path TEXT NOT NULL,
+  metadata_path TEXT,
+  start_ns INTEGER,
+  end_ns INTEGER,
+  frame_count INTEGER NOT NULL,
+  dropped_frames INTEGER NOT NULL,
+  sync_status TEXT,
+  -- In tiled mode every camera of a segment shares one video
+  UNIQUE (camera, video_path)
+);
+"""
+
+SCHEMA = SEGMENTS_TABLE.format(name='segments') + """
+CREATE INDEX IF NOT EXISTS segments_camera_start ON segments (camera, start_ns);
+CREATE INDEX IF NOT EXISTS segments_started_at ON segments (started_at);
+CREATE INDEX IF NOT EXISTS segments_segment ON segments (segment);
+"""
+
+
+def segment_stats(metadata):
+  """Summarize the (Timestamp_ns, LineStatusAll, CounterValue) rows of one segment.
+
+  Dropped frames are counted from gaps in the FrameStart counter, so a trigger the camera saw but never delivered still
+  shows up here.
+  """
+  if not metadata:
+    return None, None, 0, 0
+
+  dropped = 0
+  previous = None
+  for _, _, counter in metadata:
+    if previous is not None and counter - previous > 1:
+      dropped += counter - previous - 1
+    previous = counter
+
+  return metadata[0][0], metadata[-1][0], len(metadata), dropped
+
+
+def parse_segment_time(segment):
+  try:
+    return datetime.strptime(segment, SEGMENT_FORMAT).isoformat()
+  except ValueError:
+    return None
+
+
+class SessionCatalog:
+  """SQLite index of every finalized segment, so trials can be found without rescanning the recording directories."""
+
+  def __init__(self, path):
+    self.path = path
+    self.connection = sqlite3.connect(path)
+    self.connection.row_factory = sqlite3.Row
+
+    # WAL lets the CLI query the catalog while a recorder is appending to it
+    self.connection.execute('PRAGMA journal_mode=WAL')
+    self.migrate()
+    self.connection.executescript(SCHEMA)
+
+  def migrate(self):
+    version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+    if version >= SCHEMA_VERSION:
+      return
+
+    # Version 0 catalogs may have been created with video_path UNIQUE on its own, before tiled mode had every camera of
+    # a segment share one video. SQLite can't change a table's constraints, so the table is rebuilt with the new key;
+    # its indexes go with the old table and are recreated from SCHEMA afterwards
+    row = self.connection.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'segments'").fetchone()
+    if row and 'UNIQUE (camera, video_path)' not in row[0]:
+      columns = ', '.join(info[1] for info in self.connection.execute('PRAGMA table_info(segments)'))
+      self.connection.executescript(
+        'BEGIN;'
+        + SEGMENTS_TABLE.format(name='segments_migrated')
+        + f'INSERT INTO segments_migrated ({columns}) SELECT {columns} FROM segments;'
+        + 'DROP TABLE segments;'
+        + 'ALTER TABLE segments_migrated RENAME TO segments;'
+        + 'COMMIT;'
+      )
+
+    self.connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+  def add_segment(self, camera, segment, video_path, metadata_path, metadata, sync_status=None):
+    start_ns, end_ns, frame_count, dropped = segment_stats(metadata)
+
+    with self.connection:
+      self.connection.execute(
+        """
+        INSERT INTO segments (camera, segment, started_at, video_path, metadata_path, start_ns, end_ns, frame_count,
+                              dropped_frames, sync_status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (camera, video_path) DO UPDATE SET
+          metadata_path = excluded.metadata_path,
+          start_ns = excluded.start_ns,
+          end_ns = excluded.end_ns,
+          frame_count = excluded.frame_count,
+          dropped_frames = excluded.dropped_frames,
+          sync_status = excluded.sync_status
+        """,
+        (camera, segment, parse_segment_time(segment), os.path.abspath(video_path),
+         metadata_path and os.path.abspath(metadata_path), start_ns, end_ns, frame_count, dropped, sync_status)
+      )
+
+  def set_sync_status(self, segment, sync_status):
+    with self.connection:
+      self.connection.execute('UPDATE segments SET sync_status = ? WHERE segment = ?', (sync_status, segment))
+
+  def query(self, camera=None, after=None, before=None, start_ns=None, end_ns=None, min_frames=None, max_frames=None,
+            segment=None, sync_status=None, limit=None):
+    """Return matching segments ordered by start time.
+
+    after/before filter on the wall clock start time (ISO strings compare correctly), start_ns/end_ns on the camera's
+    hardware timestamps.
+    """
+    clauses = []
+    params = []
+    for clause, value in (
+      ('camera = ?', camera),
+      ('started_at >= ?', after),
+      ('started_at < ?', before),
+      ('end_ns >= ?', start_ns),
+      ('start_ns < ?', end_ns),
+      ('frame_count >= ?', min_frames),
+      ('frame_count <= ?', max_frames),
+      ('segment = ?', segment),
+      ('sync_status = ?', sync_status),
+    ):
+      if value is not None:
+        clauses.append(clause)
+        params.append(value)
+
+    sql = 'SELECT * FROM segments'
+    if clauses:
+      sql += ' WHERE ' + ' AND '.join(clauses)
+    sql += ' ORDER BY started_at, camera'
+    if limit is not None:
+      sql += ' LIMIT ?'
+      params.append(limit)
+
+    return self.connection.execute(sql, params).fetchall()
+
+  def index_directory(self, directory):
+    """Backfill the catalog from recordings that were made before it existed. Returns the number of segments added."""
+    added = 0
+    for root, directories, files in os.walk(directory):
+      # Tiled videos (tiled/tiled_<segment>.avi) hold every camera of a segment; they're cataloged once per camera when
+      # they're recorded, and can't be attributed to a camera from the file name
+      if 'tiled' in directories:
+        directories.remove('tiled')
+
+      names = set(files)
+      for file_name in files:
+        match = VIDEO_PATTERN.match(file_name)
+        if not match:
+          continue
+
+        camera, segment = match.group('camera'), match.group('segment')
+
+        # single_camera.py names metadata after the segment only, multi_camera.py includes the camera name
+        metadata_path = None
+        for candidate in (f'metadata_{camera}_{segment}', f'metadata_{segment}'):
+          for extension in ('', '.csv'):
+            if candidate + extension in names:
+              metadata_path = os.path.join(root, candidate + extension)
+              break
+          if metadata_path:
+            break
+
+        metadata = []
+        if file_name.endswith('.h5'):
+          # HDF5 segments carry their metadata columns in the same file
+          from segment_writers import read_segment_metadata
+
+          metadata_path = os.path.join(root, file_name)
+          columns = read_segment_metadata(metadata_path)
+          metadata = list(zip(*(columns[name].tolist() for name in METADATA_COLUMNS)))
+        elif metadata_path:
+          with open(metadata_path, newline='') as f:
+            metadata = [(int(row[0]), int(row[1]), int(row[2])) for row in csv.reader(f) if row and row[0].isdigit()]
+
+        self.add_segment(camera, segment, os.path.join(root, file_name), metadata_path, metadata)
+        added += 1
+
+    return added
+
+  def close(self):
+    self.connection.close()
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Query or rebuild the catalog of recorded segments')
+  parser.add_argument('catalog', help='Path to the catalog database')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  index_parser = commands.add_parser('index', help='Add existing recordings under one or more directories')
+  index_parser.add_argument('directories', nargs='+')
+
+  query_parser = commands.add_parser('query', help='List segments matching the given filters')
+  query_parser.add_argument('--camera')
+  query_parser.add_argument('--after', help='Wall clock start time, e.g. 2025-06-01T14:00')
+  query_parser.add_argument('--before', help='Wall clock start time, e.g. 2025-06-01T15:00')
+  query_parser.add_argument('--min-frames', type=int)
+  query_parser.add_argument('--max-frames', type=int)
+  query_parser.add_argument('--segment')
+  query_parser.add_argument('--sync-status')
+  query_parser.add_argument('--limit', type=int)
+
+  args = parser.parse_args()
+  catalog = SessionCatalog(args.catalog)
+
+  try:
+    if args.command == 'index':
+      for directory in args.directories:
+        print(f'Indexed {catalog.index_directory(directory)} segments from {directory}')
+    else:
+      rows = catalog.query(
+        camera=args.camera,
+        after=args.after,
+        before=args.before,
+        min_frames=args.min_frames,
+        max_frames=args.max_frames,
+        segment=args.segment,
+        sync_status=args.sync_status,
+        limit=args.limit
+      )
+
+      for row in rows:
+        print(f"{row['started_at']}  {row['camera']}  frames={row['frame_count']}  dropped={row['dropped_frames']}  "
+              f"sync={row['sync_status']}  {row['video_path']}")
+  finally:
+    catalog.close()
+
+
+if __name__ == '__main__':
+  main()
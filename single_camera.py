@@ -1,11 +1,20 @@
 import cv2
 import enum
-import itertools
 import os
-import pandas as pd
+import time
 
-from pypylon import pylon, genicam
+from pypylon import pylon
 from datetime import datetime, timedelta
+from session_catalog import SessionCatalog
+from frame_quality import FrameQualityWorker
+from segment_writers import AviSegmentWriter
+from devices import create_device, merge_device_maps
+from packed_formats import PACKED_FORMATS, bit_depth, unpack
+from camera_events import CameraEventMonitor
+from scheduling import apply_role
+from acquisition_log import AcquisitionLog
+from proxy_writer import ProxyWorker
+from rig_config import RigConfig, apply_plan, compile_plan
 
 class CameraState(enum.Enum):
    Idle = enum.auto()
@@ -14,123 +23,227 @@ class CameraState(enum.Enum):
 
 
 class Context:
-  def __init__(self):
-    # Discover and connect to camera
+  def __init__(self, frame_bus=None, device_map=None, segment_writer=AviSegmentWriter, pixel_format=None, proxies=True,
+               rig=None, segment_options=None):
+    # Packed 10/12-bit formats are unpacked to uint16 on the host, which only some segment writers can store
+    if pixel_format and pixel_format not in PACKED_FORMATS:
+      raise ValueError(f'Unsupported pixel format {pixel_format}; expected one of {", ".join(PACKED_FORMATS)}')
+    if pixel_format and not segment_writer.high_bit_depth:
+      raise ValueError(f'{pixel_format} frames are 16-bit and can only be recorded with the hdf5 format')
+
+    # Camera settings come from the rig description (see rig_config.py); its defaults are what this script always set
+    self.rig = rig or RigConfig()
+    self.settings = self.rig.settings('camA')
+    if pixel_format:
+      self.settings['pixel_format'] = pixel_format
+
+    # Connect to camA by its stored serial number if we have one, otherwise to whichever camera is found first. Serials in
+    # the rig description take precedence over the device map
+    device_map = merge_device_maps(device_map, self.rig.device_map())
     tlf = pylon.TlFactory.GetInstance()
-    self.cam = pylon.InstantCamera(tlf.CreateFirstDevice())
+    if 'camA' in device_map:
+      self.cam = pylon.InstantCamera(create_device(tlf, 'camA', device_map))
+    else:
+      self.cam = pylon.InstantCamera(tlf.CreateFirstDevice())
     self.cam.Open()
     self.camera_state = CameraState.Idle
-    self.trigger_line = 3
-    self.trigger_line_id = f'Line{self.trigger_line}'
     self.fourcc = cv2.VideoWriter_fourcc(*'XVID')
-    self.frame_rate = 200.0
+    self.frame_rate = float(self.settings['frame_rate'] or 200.0)
     self.sampling_rate = 1.0 / self.frame_rate
-    self.output_resolution = (800, 600)
-
-    # Load the default camera configuration 
-    self.cam.UserSetSelector.Value = "Default"
-    self.cam.UserSetLoad.Execute()
+    self.output_resolution = (self.settings['roi']['width'], self.settings['roi']['height'])
 
     # Select recording settings
     self.camera_dir = os.path.join('D', os.path.sep, 'abi_data', 'raw_data', 'setup', 'test_cameras', 'camA')
     os.makedirs(self.camera_dir, exist_ok=True) 
 
-    # Set the chunks you want (metadata). Here we want to sample IO lines on each framestart trigger 
-    chunks = ["LineStatusAll", "Timestamp", "CounterValue"]
-    self.cam.ChunkModeActive.SetValue(True) #attach metadata to each image 
-    for chunk in chunks:
-      self.cam.ChunkSelector.SetValue(chunk) #metadata about IO line status for each image (state of TTL pulse)
-      if chunk == "CounterValue":
-        self.cam.CounterSelector.SetValue("Counter1")
-        self.cam.CounterEventSource.SetValue("FrameStart")
-      self.cam.ChunkEnable.SetValue(True) #activates chunk you are interested in (LineStatus)
-
-      if not self.cam.ChunkEnable.GetValue():
-        print(f'Tried to enable chunk {chunk}, but it reported as disabled')
-
-    # Set image quality and format settings 
-    self.cam.Height.SetValue(600)
-    self.cam.Width.SetValue(800)
-    self.cam.ExposureTime.SetValue(3000)
-    self.cam.AcquisitionFrameRateEnable.SetValue(True)
-    self.cam.AcquisitionFrameRate.SetValue(200)
-    self.cam.GainAuto.SetValue("Continuous")
-
-    # Setup the trigger/acquisition controls 
-    self.cam.TriggerSelector.SetValue("FrameStart")
-    self.cam.TriggerActivation.SetValue("RisingEdge")
-    self.cam.TriggerSource.SetValue(self.trigger_line_id)
-    self.cam.TriggerMode.SetValue("On")
+    # Every finished video is indexed so trials can be looked up without rescanning the recording directories
+    self.catalog = SessionCatalog(os.path.join(os.path.dirname(self.camera_dir), 'catalog.sqlite'))
+
+    # Segment boundaries and other diagnostics are logged as JSON lines from a background thread, not printed in the loop
+    self.log = AcquisitionLog(os.path.join(self.camera_dir, 'acquisition.jsonl'))
+
+    # Chunks (IO line status, timestamp and FrameStart counter on every frame), ROI, exposure and trigger. Only the nodes
+    # that differ from what the camera already has are written, so a camera left configured by the last session is
+    # ready right away
+    self.configuration = apply_plan(self.cam, compile_plan(self.settings))
+    self.log.info('configured', 'Configured camA: {summary}', summary=self.configuration.summary())
+    for node, selectors, expected, actual in self.configuration.mismatches:
+      self.log.warning('setting_mismatch', 'Tried to set {node} to {expected} ({selectors}), but it reads {actual}',
+                       node=node, selectors=dict(selectors), expected=expected, actual=actual)
+
+    # With pixel_format set (Mono10p or Mono12p), frames are unpacked to uint16 instead of going through the converter
+    self.pixel_format = pixel_format
+
+    # Overtriggers and the other camera events are logged per segment, placed between frames by their timestamps
+    self.events = CameraEventMonitor(log=self.log)
+    self.events.enable(self.cam, 'camA')
 
     # Create an image format converter
     self.converter = pylon.ImageFormatConverter()
     self.converter.OutputPixelFormat = pylon.PixelType_BGR8packed  # For OpenCV (color)
     self.converter.OutputBitAlignment = pylon.OutputBitAlignment_MsbAligned
 
-    # We'll start a new video whenever the beam is broken, so just make a placeh
-    self.video_writer: cv2.VideoWriter = None
+    # We'll start a new video whenever the beam is broken, so just make a placeh. segment_writer decides the file format;
+    # DurableSegmentWriter keeps a segment readable if the recording PC crashes halfway through a trial
+    self.segment_writer = segment_writer
+    self.segment_options = segment_options or {}
+    self.video_writer = None
 
     self.metadata = []
     self.video_timestamp = None
+
+    # Brightness, saturation and motion are computed from downsampled frames on a worker thread and added to the metadata
+    saturation_level = (1 << bit_depth(self.pixel_format)) - 1 if self.pixel_format else 255
+    self.quality = FrameQualityWorker(saturation_level=saturation_level)
+
+    # Low-resolution, decimated review copies of every segment, encoded from the same frames on a background thread
+    self.proxies = None
+    if proxies:
+      self.proxies = ProxyWorker(self.frame_rate, bit_depth=bit_depth(self.pixel_format) if self.pixel_format else 8)
+
+    # Optional frame_bus.FrameBus; when set, every frame and its chunk metadata is published for live consumers
+    self.frame_bus = frame_bus
+
     self.frame_timestamp = 0
     self.max_frame_delta = timedelta(seconds=self.sampling_rate * 1.5)
 
+    # Rather than blocking until the next beam break, we poll for frames with a short timeout. Once no trigger has arrived
+    # for idle_timeout, the current video is finished so it can be read downstream while we wait for the next trial
+    self.retrieve_timeout_ms = 50
+    self.idle_timeout = timedelta(seconds=0.25)
+    self.last_frame_time = 0.0
+
+  def start_video(self):
+    self.video_timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')
+    file_name = f'camA_{self.video_timestamp}{self.segment_writer.extension}'
+    self.video_path = os.path.join(self.camera_dir, file_name)
+    self.metadata_path = os.path.join(self.camera_dir, f'metadata_{self.video_timestamp}')
+
+    self.log.info('video_start', 'Starting new video at {path}', path=self.video_path)
+
+    self.video_writer = self.segment_writer(
+      self.video_path,
+      self.metadata_path,
+      self.fourcc,
+      self.frame_rate,
+      self.output_resolution,
+      **self.segment_options
+    )
+
+    # Some formats (HDF5) keep the metadata in the video file itself
+    self.metadata_path = self.video_writer.metadata_path
+    self.metadata = []
+
+    if self.proxies:
+      self.proxies.start_segment(
+        'camA',
+        os.path.join(self.camera_dir, f'proxy_camA_{self.video_timestamp}.avi'),
+        os.path.join(self.camera_dir, f'thumbnails_camA_{self.video_timestamp}.jpg')
+      )
+
+  def finish_video(self):
+    self.log.info('video_finish', 'Finishing previous video')
+    if self.proxies:
+      self.proxies.finish_segment('camA')
+    self.video_writer.close(self.metadata, self.quality.collect('camA', len(self.metadata)))
+    if self.video_writer.stats:
+      self.log.info('segment_writer_stats', 'camA segment writer: {stats}', segment=self.video_timestamp,
+                    stats=self.video_writer.stats)
+    self.video_writer = None
+
+    self.catalog.add_segment('camA', self.video_timestamp, self.video_path, self.metadata_path, self.metadata)
+
+    events_path = os.path.join(self.camera_dir, f'events_{self.video_timestamp}.csv')
+    event_counts = self.events.collect('camA', self.metadata, events_path)
+    if event_counts['FrameStartOvertrigger']:
+      self.log.warning('overtrigger', '{overtriggers} triggers arrived faster than the camera could take frames',
+                       segment=self.video_timestamp, overtriggers=event_counts['FrameStartOvertrigger'])
+
+    self.metadata = []
+
+  def read_frame(self, grab):
+    # Packed frames skip the converter: the vectorized unpacker is faster, and keeps all 10/12 bits
+    if self.pixel_format:
+      return unpack(grab.GetBuffer(), grab.GetWidth(), grab.GetHeight(), self.pixel_format)
+
+    return self.converter.Convert(grab).GetArray()
+
   def run_loop(self):
+    # Before anything is started from this thread, so pylon's own grab threads end up on the grab CPUs too
+    apply_role('grab')
+    self.quality.start()
+    self.events.start()
+    if self.proxies:
+      self.proxies.start()
     self.cam.StartGrabbing(pylon.GrabStrategy_OneByOne, pylon.GrabLoop_ProvidedByUser) # Starts a steady stream of images, provides 1 frame at a time when triggered 
     
     try:
       while True:
-        grab = self.cam.RetrieveResult(pylon.waitForever, pylon.TimeoutHandling_Return)
+        grab = self.cam.RetrieveResult(self.retrieve_timeout_ms, pylon.TimeoutHandling_Return)
+
+        # No trigger within the timeout; once we've been idle long enough, finish the video instead of holding it open
+        # until the next beam break
+        if not grab.IsValid():
+          if self.video_writer and time.monotonic() - self.last_frame_time > self.idle_timeout.total_seconds():
+            self.log.info('idle_timeout', 'No trigger for {idle_s}s; assuming beam status changed',
+                          idle_s=self.idle_timeout.total_seconds())
+            self.finish_video()
+          continue
+
+        self.last_frame_time = time.monotonic()
 
         frame_delta = grab.GetTimeStamp() - self.frame_timestamp
         max_frame_delta = self.max_frame_delta.total_seconds() * (10 ** 9) # Convert our delta from seconds to nanoseconds
 
         if frame_delta > max_frame_delta:
-          print(f'Frame delta exceeded; delta = {frame_delta}, max delta = {max_frame_delta}; assuming beam status changed and starting a new video')
+          self.log.info('frame_delta_exceeded', 'Frame delta exceeded; delta = {delta}, max delta = {max_delta}; assuming beam status changed and starting a new video',
+                        delta=frame_delta, max_delta=max_frame_delta)
 
-          # If this is our first video, there's no current video to finalize
+          # If this is our first video, or the last one was finished when triggers stopped, there's nothing to finalize
           if self.video_writer:
-            print('Finishing previous video')
-            self.video_writer.release()
+            self.finish_video()
 
-            file_name = f'metadata_{self.video_timestamp}'
-            file_path = os.path.join(self.camera_dir, file_name)
-            df = pd.DataFrame(self.metadata, columns=["Timestamp_ns", "LineStatusAll", "CounterValue"])
-            df.to_csv(file_path, index=False)
+          self.start_video()
 
-          # Start a new video
-          self.video_timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')
-          file_name = f'camA_{self.video_timestamp}.avi'
-          file_path = os.path.join(self.camera_dir, file_name)
-
-          print(f'Starting new video at {file_path}')
-
-          self.video_writer = cv2.VideoWriter(
-            file_path,
-            self.fourcc,
-            self.frame_rate,
-            self.output_resolution
-          )
-
-          self.metadata = []
+        elif not self.video_writer:
+          # The idle timeout fired even though the camera clock says this frame belongs to the same trial
+          self.start_video()
 
         self.frame_timestamp = grab.GetTimeStamp()
 
-        frame = self.converter.Convert(grab).GetArray()
-        self.video_writer.write(frame)
+        frame = self.read_frame(grab)
 
         metadata = (
           grab.ChunkTimestamp.Value,
           grab.ChunkLineStatusAll.Value,
           grab.ChunkCounterValue.Value
         )
+
+        self.video_writer.write(frame, metadata)
+        self.quality.submit('camA', len(self.metadata), frame)
+        if self.proxies:
+          self.proxies.submit('camA', len(self.metadata), frame)
         self.metadata.append(metadata)
 
+        if self.frame_bus:
+          self.frame_bus.publish('camA', frame, metadata)
+
     except KeyboardInterrupt:
-       print('Recording was stopped by user.')
+       self.log.info('stopped', 'Recording was stopped by user.')
     finally:
+      if self.video_writer:
+        self.finish_video()
+
       self.cam.StopGrabbing()
       self.cam.Close()
+      self.quality.stop()
+      self.events.stop()
+      if self.proxies:
+        self.proxies.stop()
+      if self.frame_bus:
+        self.frame_bus.close()
+      self.catalog.close()
+      self.log.close()
       cv2.destroyAllWindows()
 
 if __name__ == '__main__':
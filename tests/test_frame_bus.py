@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+import pytest
+
+from frame_bus import FrameBus, FrameSubscriber
+
+
+@pytest.fixture
+def prefix():
+  return f'test{os.getpid()}'
+
+
+def test_mono_frames_keep_their_shape(prefix):
+  bus = FrameBus(prefix)
+  frame = np.arange(48, dtype=np.uint16).reshape(6, 8)
+  try:
+    bus.publish('camA', frame, (1, 2, 3))
+    subscriber = FrameSubscriber('camA', prefix, timeout=1)
+    bus.publish('camA', frame + 1, (4, 5, 6))
+
+    received, metadata = subscriber.latest()
+    subscriber.close()
+  finally:
+    bus.close()
+
+  assert received.shape == (6, 8)
+  np.testing.assert_array_equal(received, frame + 1)
+  assert (metadata['timestamp'], metadata['line_status'], metadata['counter']) == (4, 5, 6)
+
+
+def test_ring_of_a_running_publisher_is_not_taken_over(prefix):
+  first = FrameBus(prefix)
+  second = FrameBus(prefix)
+  frame = np.zeros((6, 8, 3), np.uint8)
+  try:
+    first.publish('camA', frame, (1, 2, 3))
+    with pytest.warns(UserWarning, match='in use'):
+      second.publish('camA', frame, (1, 2, 3))
+    second.publish('camA', frame, (4, 5, 6))
+
+    assert 'camA' in second.unavailable
+    assert 'camA' not in second.rings
+  finally:
+    second.close()
+    first.close()
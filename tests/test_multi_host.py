@@ -0,0 +1,115 @@
+import os
+import queue
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from metadata_log import write_metadata
+from multi_host import Coordinator, Node
+
+
+class FakeContext:
+  """Stands in for multi_camera.Context: one loop thread runs the commands and 'triggers' every camera each millisecond,
+  like emulated cameras driven by a shared trigger."""
+
+  def __init__(self, camera_names, output_root):
+    self.camera_names = list(camera_names)
+    self.output_root = output_root
+    self.commands = queue.SimpleQueue()
+    self.running = True
+    self.recording = False
+    self.auto_segment = True
+    self.frames_discarded = 0
+    self.label = None
+    self.counter = 0
+    self.metadata = {name: [] for name in self.camera_names}
+    self.cameras = {}
+    self.quality = type('Quality', (), {'dropped': 0})()
+    self.events = type('Events', (), {'counts': {}})()
+
+  def start_videos(self, label):
+    self.label = label
+    self.recording = True
+
+  def finish_videos(self):
+    segments = []
+    for name, metadata in self.metadata.items():
+      path = os.path.join(self.output_root, f'metadata_{name}_{self.label}')
+      write_metadata(path, metadata)
+      segments.append({'camera': name, 'segment': self.label, 'metadata_path': path, 'frame_count': len(metadata)})
+      self.metadata[name] = []
+    self.recording = False
+    return segments
+
+  def run_loop(self):
+    try:
+      while self.running:
+        while True:
+          try:
+            command, reply = self.commands.get_nowait()
+          except queue.Empty:
+            break
+          try:
+            reply.put(command())
+          except Exception as e:
+            reply.put(e)
+
+        self.counter += 1
+        if self.recording:
+          for metadata in self.metadata.values():
+            metadata.append((self.counter * 1000, 0, self.counter))
+        time.sleep(0.001)
+    finally:
+      self.running = False
+
+
+def start_node(context):
+  node = Node(context, 0)
+  thread = threading.Thread(target=node.run, daemon=True)
+  thread.start()
+  return node, thread, f'127.0.0.1:{node.server.server_address[1]}'
+
+
+@pytest.fixture
+def nodes(tmp_path):
+  started = []
+  for index, cameras in enumerate((['camA', 'camB'], ['camC'])):
+    directory = tmp_path / f'node{index}'
+    directory.mkdir()
+    started.append(start_node(FakeContext(cameras, str(directory))))
+
+  yield started
+
+  for node, thread, _ in started:
+    node.context.running = False
+    thread.join(timeout=5)
+
+
+def test_coordinated_segment_is_merged(nodes, tmp_path):
+  coordinator = Coordinator([address for _, _, address in nodes], str(tmp_path / 'sessions'))
+  try:
+    assert coordinator.start_segment('trial1') is None
+    time.sleep(0.05)
+    session = coordinator.stop_segment()
+  finally:
+    coordinator.close()
+
+  assert session['segment'] == 'trial1'
+  assert sorted(camera['camera'] for camera in session['cameras']) == ['camA', 'camB', 'camC']
+  assert all(camera['frame_count'] > 0 for camera in session['cameras'])
+
+  merged = pd.read_csv(session['metadata_path'])
+  assert sorted(merged['Camera'].unique()) == ['camA', 'camB', 'camC']
+  assert len(merged) == sum(camera['frame_count'] for camera in session['cameras'])
+  assert os.path.exists(os.path.join(tmp_path, 'sessions', 'session_trial1.json'))
+
+
+def test_node_without_grab_loop_replies_with_error(nodes, tmp_path):
+  node, thread, address = nodes[0]
+  node.context.running = False
+  thread.join(timeout=5)
+
+  # The server is gone along with the loop, so talk to the handler directly, as a connection accepted before would
+  assert node.handle({'command': 'stats'})['ok'] is False
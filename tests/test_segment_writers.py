@@ -0,0 +1,47 @@
+import threading
+import time
+
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+
+from segment_writers import AviSegmentWriter, DurableSegmentWriter, EncoderThread
+
+RESOLUTION = (16, 12)
+
+
+@pytest.mark.parametrize('segment_writer', [AviSegmentWriter, DurableSegmentWriter])
+def test_frames_are_encoded_off_the_calling_thread(segment_writer, tmp_path):
+  video_path = str(tmp_path / f'camA{segment_writer.extension}')
+  writer = segment_writer(video_path, str(tmp_path / 'metadata_camA'), cv2.VideoWriter_fourcc(*'XVID'), 200.0, RESOLUTION)
+
+  encode = writer.encode
+  threads = set()
+  writer.encode = lambda frame, metadata: (threads.add(threading.current_thread().name), encode(frame, metadata))
+  writer.encoder.encode = writer.encode
+
+  metadata = [(k * 1000, 0, k) for k in range(20)]
+  for row in metadata:
+    writer.write(np.full((RESOLUTION[1], RESOLUTION[0], 3), row[2] * 10, np.uint8), row)
+  writer.close(metadata)
+
+  assert threads and threading.current_thread().name not in threads
+  assert int(cv2.VideoCapture(video_path).get(cv2.CAP_PROP_FRAME_COUNT)) == len(metadata)
+  assert pd.read_csv(tmp_path / 'metadata_camA')['CounterValue'].tolist() == list(range(20))
+
+
+def test_encoder_failure_is_raised_to_the_caller():
+  def encode(frame, metadata):
+    raise ValueError('disk full')
+
+  encoder = EncoderThread(encode, 'test-encoder', max_pending=2)
+  encoder.put(None, None)
+  deadline = time.monotonic() + 5
+  while encoder.error is None and time.monotonic() < deadline:
+    time.sleep(0.01)
+
+  with pytest.raises(ValueError, match='disk full'):
+    encoder.put(None, None)
+  with pytest.raises(ValueError, match='disk full'):
+    encoder.close()
@@ -0,0 +1,66 @@
+import sqlite3
+
+from session_catalog import SCHEMA_VERSION, SessionCatalog
+
+# The schema catalogs were created with before tiled mode, where video_path alone was unique
+OLD_SCHEMA = """
+CREATE TABLE segments (
+  id INTEGER PRIMARY KEY,
+  camera TEXT NOT NULL,
+  segment TEXT NOT NULL,
+  started_at TEXT,
+  video_path TEXT NOT NULL UNIQUE,
+  metadata_path TEXT,
+  start_ns INTEGER,
+  end_ns INTEGER,
+  frame_count INTEGER NOT NULL,
+  dropped_frames INTEGER NOT NULL,
+  sync_status TEXT
+);
+CREATE INDEX segments_camera_start ON segments (camera, start_ns);
+CREATE INDEX segments_started_at ON segments (started_at);
+CREATE INDEX segments_segment ON segments (segment);
+INSERT INTO segments (camera, segment, started_at, video_path, frame_count, dropped_frames, sync_status)
+VALUES ('camA', '2025-06-01_14-03-22-123456', '2025-06-01T14:03:22.123456', '/data/camA.avi', 10, 0, 'ok');
+"""
+
+SEGMENT = '2025-06-01_14-03-22-123456'
+
+
+def test_old_catalog_is_migrated(tmp_path):
+  path = str(tmp_path / 'catalog.sqlite')
+  connection = sqlite3.connect(path)
+  connection.executescript(OLD_SCHEMA)
+  connection.close()
+
+  catalog = SessionCatalog(path)
+  try:
+    assert catalog.connection.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+    assert [(row['camera'], row['frame_count']) for row in catalog.query()] == [('camA', 10)]
+
+    # Upserts on the new key work, and tiled segments can share a video between cameras
+    catalog.add_segment('camA', SEGMENT, '/data/camA.avi', None, [(1, 0, 1), (2, 0, 2)])
+    catalog.add_segment('camA', SEGMENT, '/data/tiled.avi', None, [(1, 0, 1)])
+    catalog.add_segment('camB', SEGMENT, '/data/tiled.avi', None, [(1, 0, 1)])
+
+    rows = {(row['camera'], row['video_path']): row['frame_count'] for row in catalog.query()}
+    assert rows == {('camA', '/data/camA.avi'): 2, ('camA', '/data/tiled.avi'): 1, ('camB', '/data/tiled.avi'): 1}
+
+    indexes = {row[0] for row in catalog.connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {'segments_camera_start', 'segments_started_at', 'segments_segment'} <= indexes
+  finally:
+    catalog.close()
+
+
+def test_new_catalog_is_left_alone(tmp_path):
+  path = str(tmp_path / 'catalog.sqlite')
+  SessionCatalog(path).close()
+
+  catalog = SessionCatalog(path)
+  try:
+    assert catalog.connection.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+    catalog.add_segment('camA', SEGMENT, '/data/tiled.avi', None, [(1, 0, 1)])
+    catalog.add_segment('camB', SEGMENT, '/data/tiled.avi', None, [(1, 0, 1)])
+    assert len(catalog.query()) == 2
+  finally:
+    catalog.close()
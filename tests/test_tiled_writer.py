@@ -0,0 +1,78 @@
+import csv
+
+import cv2
+import numpy as np
+import pytest
+
+from tiled_writer import TiledSegmentWriter
+
+TILE = (8, 6)
+
+
+@pytest.fixture
+def tiled(tmp_path):
+  writer = TiledSegmentWriter(
+    str(tmp_path / 'tiled.avi'), str(tmp_path / 'tiles.csv'), ['camA', 'camB'], cv2.VideoWriter_fourcc(*'XVID'), 200.0,
+    TILE, max_open=4
+  )
+  writer.sidecar_rows = lambda: list(csv.DictReader(open(tmp_path / 'tiles.csv')))
+  return writer
+
+
+def frame(value):
+  return np.full((TILE[1], TILE[0], 3), value, np.uint8)
+
+
+def close(tiled):
+  for _ in tiled.camera_names:
+    tiled.release()
+
+
+def tiles_by_mosaic(rows):
+  mosaics = {}
+  for row in rows:
+    mosaics.setdefault(int(row['TiledFrame']), {})[row['Camera']] = int(row['CounterValue'])
+  return mosaics
+
+
+def test_missed_trigger_only_affects_its_own_mosaic(tiled):
+  # The cameras' counters start at different values; camB misses the third trigger
+  for k in range(6):
+    tiled.add(0, frame(10), (k, 0, 100 + k))
+    if k != 2:
+      tiled.add(1, frame(20), (k, 0, 500 + k))
+  assert not tiled.pending
+  close(tiled)
+
+  mosaics = tiles_by_mosaic(tiled.sidecar_rows())
+  assert sorted(mosaics) == list(range(6))
+  assert mosaics[2] == {'camA': 102}
+  for k in (0, 1, 3, 4, 5):
+    assert mosaics[k] == {'camA': 100 + k, 'camB': 500 + k}
+
+
+def test_camera_that_stops_delivering_bounds_open_mosaics(tiled):
+  tiled.add(1, frame(20), (0, 0, 500))
+  for k in range(20):
+    tiled.add(0, frame(10), (k, 0, 100 + k))
+    assert len(tiled.pending) <= tiled.max_open
+  close(tiled)
+
+  mosaics = tiles_by_mosaic(tiled.sidecar_rows())
+  assert sorted(mosaics) == list(range(20))
+  assert mosaics[0] == {'camA': 100, 'camB': 500}
+  assert all(mosaics[k] == {'camA': 100 + k} for k in range(1, 20))
+
+
+def test_tile_for_a_mosaic_already_sent_is_counted_late(tiled):
+  tiled.add(1, frame(20), (0, 0, 500))
+  for k in range(tiled.max_open + 2):
+    tiled.add(0, frame(10), (k, 0, 100 + k))
+
+  # camB's tile for the second trigger arrives after its mosaic was forced out
+  tiled.add(1, frame(20), (1, 0, 501))
+  assert tiled.late_tiles == 1
+  close(tiled)
+
+  mosaics = tiles_by_mosaic(tiled.sidecar_rows())
+  assert mosaics[1] == {'camA': 101}
@@ -0,0 +1,49 @@
+import csv
+
+import numpy as np
+import pytest
+
+from metadata_log import METADATA_COLUMNS
+from timing_qc import Session
+
+
+def write_segment(path, line_status):
+  with open(path, 'w', newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(METADATA_COLUMNS)
+    for i, status in enumerate(line_status):
+      writer.writerow((i * 5_000_000, status, i))
+
+
+@pytest.fixture
+def segment(tmp_path):
+  # Line3 is high for runs of 3, 4 and 2 frames, the last one still open when the segment ends; Line1 toggles every frame
+  line3 = [0, 1, 1, 1, 0, 0, 1, 1, 1, 1, 0, 1, 1]
+  line_status = [(bit << 3) | ((i % 2) << 1) for i, bit in enumerate(line3)]
+  path = tmp_path / 'metadata_camA_2025-06-01_14-03-22-123456.csv'
+  write_segment(path, line_status)
+  return str(path)
+
+
+def report(path, chunk_rows):
+  session = Session(trigger_line=3, chunk_rows=chunk_rows)
+  session.add_segment('2025-06-01_14-03-22-123456', {'camA': path})
+  return session.report()
+
+
+@pytest.mark.parametrize('chunk_rows', [1, 2, 3, 4, 5, 7])
+def test_report_does_not_depend_on_chunk_size(segment, chunk_rows):
+  assert report(segment, chunk_rows) == report(segment, 1000)
+
+
+def test_high_periods(segment):
+  lines = report(segment, 4)['cameras']['camA']['lines']
+
+  line3 = lines['Line3']['high_period_frames']
+  assert line3['count'] == 3
+  assert line3['mean'] == pytest.approx(3.0)
+  assert (line3['min'], line3['max']) == (2, 4)
+
+  line1 = lines['Line1']['high_period_frames']
+  assert line1['count'] == 6
+  assert line1['max'] == 1
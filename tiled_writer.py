@@ -0,0 +1,208 @@
+import argparse
+import csv
+import math
+import os
+import queue
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from metadata_log import METADATA_COLUMNS, write_metadata
+from scheduling import apply_role
+
+# Tiled mode packs the synchronized frames of all cameras into one NxM mosaic per trigger and feeds a single encoder, so
+# a trial is one video instead of one per camera. Every camera sees the same Arduino pulses, so a frame's FrameStart
+# counter, relative to that camera's first counter in the segment, says which trigger it belongs to; that's how tiles are
+# matched up, and a camera that misses a trigger only leaves a black tile in that one mosaic. A sidecar CSV maps every
+# tile back to its camera and chunk metadata.
+
+SIDECAR_COLUMNS = ["TiledFrame", "Camera", "Row", "Column"] + METADATA_COLUMNS
+
+
+def grid_for(num_cameras):
+  columns = math.ceil(math.sqrt(num_cameras))
+  return math.ceil(num_cameras / columns), columns
+
+
+class TiledSegmentWriter:
+  """Writes one segment of every camera as a single tiled video, encoded on its own thread."""
+
+  def __init__(self, video_path, sidecar_path, camera_names, fourcc, frame_rate, tile_resolution, grid=None,
+               max_pending=16, max_open=8):
+    self.video_path = video_path
+    self.sidecar_path = sidecar_path
+    self.camera_names = list(camera_names)
+    self.rows, self.columns = grid or grid_for(len(self.camera_names))
+    self.tile_width, self.tile_height = tile_resolution
+
+    self.video_writer = cv2.VideoWriter(
+      video_path,
+      fourcc,
+      frame_rate,
+      (self.tile_width * self.columns, self.tile_height * self.rows)
+    )
+    self.sidecar_file = open(sidecar_path, 'w', newline='')
+    self.sidecar = csv.writer(self.sidecar_file)
+    self.sidecar.writerow(SIDECAR_COLUMNS)
+
+    self.first_counters = [None] * len(self.camera_names)
+    self.pending = {}
+    self.next_index = 0
+    self.late_tiles = 0
+
+    # Mosaics still waiting for tiles. If a camera stops delivering, none of them would ever complete, so beyond max_open
+    # the oldest is sent as it is
+    self.max_open = max_open
+    self.open_tiles = len(self.camera_names)
+
+    # The grab loop only copies tiles into a canvas; encoding and the sidecar happen on this thread
+    self.queue = queue.Queue(maxsize=max_pending)
+    self.encoder = threading.Thread(target=self.run_encoder, name='tiled-encoder', daemon=True)
+    self.encoder.start()
+
+  def tile(self, position, metadata_path):
+    return TileWriter(self, position, metadata_path)
+
+  def add(self, position, frame, metadata):
+    counter = metadata[2]
+    if self.first_counters[position] is None:
+      self.first_counters[position] = counter
+    index = counter - self.first_counters[position]
+
+    # Its mosaic was already sent without it (or the counter went backwards)
+    if index < self.next_index:
+      self.late_tiles += 1
+      return
+
+    canvas, tiles = self.pending.get(index, (None, None))
+    if canvas is None:
+      canvas = np.zeros((self.tile_height * self.rows, self.tile_width * self.columns) + frame.shape[2:], frame.dtype)
+      tiles = {}
+      self.pending[index] = (canvas, tiles)
+
+    row, column = divmod(position, self.columns)
+    canvas[row * self.tile_height:(row + 1) * self.tile_height,
+           column * self.tile_width:(column + 1) * self.tile_width] = frame
+    tiles[position] = metadata
+
+    if len(tiles) == len(self.camera_names):
+      self.flush(index)
+    elif len(self.pending) > self.max_open:
+      self.flush(min(self.pending))
+
+  def flush(self, last_index):
+    # A camera that skipped a trigger would hold back every later mosaic, so once a later one is complete, earlier ones
+    # are sent with their missing tiles left black (and absent from the sidecar)
+    while self.next_index <= last_index:
+      canvas, tiles = self.pending.pop(self.next_index, (None, None))
+      if canvas is not None:
+        self.queue.put((self.next_index, canvas, tiles))
+      self.next_index += 1
+
+  def release(self):
+    self.open_tiles -= 1
+    if self.open_tiles:
+      return
+
+    if self.pending:
+      self.flush(max(self.pending))
+    self.queue.put(None)
+    self.encoder.join()
+
+    self.video_writer.release()
+    self.sidecar_file.close()
+
+  def run_encoder(self):
+    apply_role('encoder')
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+
+      index, canvas, tiles = item
+      self.video_writer.write(canvas)
+      for position, metadata in sorted(tiles.items()):
+        row, column = divmod(position, self.columns)
+        self.sidecar.writerow((index, self.camera_names[position], row, column) + tuple(metadata))
+
+
+class TileWriter:
+  """One camera's view of a TiledSegmentWriter, with the same interface as the per-camera segment writers."""
+
+  stats = None
+
+  def __init__(self, tiled, position, metadata_path):
+    self.tiled = tiled
+    self.position = position
+    self.video_path = tiled.video_path
+    self.metadata_path = metadata_path
+
+  def write(self, frame, metadata):
+    self.tiled.add(self.position, frame, metadata)
+
+  def close(self, metadata, extra_columns=None):
+    write_metadata(self.metadata_path, metadata, extra_columns)
+    self.tiled.release()
+
+
+def benchmark(num_cameras=4, frames=400, resolution=(800, 600), frame_rate=200.0):
+  """Compare frames per second (per camera) of per-camera writers against one tiled writer on synthetic frames."""
+  fourcc = cv2.VideoWriter_fourcc(*'XVID')
+  width, height = resolution
+
+  # Smooth, moving content compresses more like real footage than noise does
+  x = np.arange(width)[None, :, None]
+  y = np.arange(height)[:, None, None]
+  source = [
+    ((x + y * (camera + 1) + np.arange(3)) % 256).astype(np.uint8)
+    for camera in range(num_cameras)
+  ]
+
+  results = {}
+  with tempfile.TemporaryDirectory() as directory:
+    writers = [
+      cv2.VideoWriter(os.path.join(directory, f'cam{camera}.avi'), fourcc, frame_rate, resolution)
+      for camera in range(num_cameras)
+    ]
+    start = time.perf_counter()
+    for i in range(frames):
+      for camera, writer in enumerate(writers):
+        writer.write(np.roll(source[camera], i, axis=1))
+    for writer in writers:
+      writer.release()
+    results['per_camera_fps'] = frames / (time.perf_counter() - start)
+
+    names = [f'cam{camera}' for camera in range(num_cameras)]
+    tiled = TiledSegmentWriter(
+      os.path.join(directory, 'tiled.avi'), os.path.join(directory, 'tiles.csv'), names, fourcc, frame_rate, resolution
+    )
+    tiles = [tiled.tile(camera, os.path.join(directory, f'metadata_{camera}')) for camera in range(num_cameras)]
+    metadata = [[] for _ in range(num_cameras)]
+    start = time.perf_counter()
+    for i in range(frames):
+      for camera, tile in enumerate(tiles):
+        tile.write(np.roll(source[camera], i, axis=1), (i, 0, i))
+        metadata[camera].append((i, 0, i))
+    for camera, tile in enumerate(tiles):
+      tile.close(metadata[camera])
+    results['tiled_fps'] = frames / (time.perf_counter() - start)
+
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark tiled encoding against one writer per camera')
+  parser.add_argument('--cameras', type=int, default=4)
+  parser.add_argument('--frames', type=int, default=400)
+  args = parser.parse_args()
+
+  results = benchmark(args.cameras, args.frames)
+  print(f'Per-camera writers: {results["per_camera_fps"]:.1f} fps per camera')
+  print(f'Tiled writer:       {results["tiled_fps"]:.1f} fps per camera')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,416 @@
+import argparse
+import glob
+import json
+import os
+import re
+
+import numpy as np
+
+from metadata_log import METADATA_COLUMNS
+
+# Timing QC that scales to a whole day of recordings. Metadata logs are read a chunk of rows at a time and folded into
+# fixed size accumulators (histograms, counts, running sums), so memory stays bounded no matter how long the session is.
+# Within a segment, state that spans chunk boundaries (last timestamp, counter and line status) is carried over; across
+# segments it's reset, since the gap between trials isn't a frame interval.
+
+CHUNK_ROWS = 100_000
+NUM_LINES = 8
+
+# Inter-frame intervals and skews are histogrammed in microseconds
+IFI_BIN_US = 10
+IFI_MAX_US = 100_000
+SKEW_BIN_US = 1
+SKEW_MAX_US = 10_000
+
+METADATA_PATTERN = re.compile(r'^metadata_(?:(?P<camera>[^_]+)_)?(?P<segment>\d{4}-\d{2}-\d{2}_[\d-]+)(\.csv)?$')
+
+
+class ChunkReader:
+  """Reads one segment's Timestamp_ns, LineStatusAll and CounterValue in chunks, from a CSV log or an HDF5 segment."""
+
+  def __init__(self, path, chunk_rows=CHUNK_ROWS):
+    self.path = path
+    self.chunk_rows = chunk_rows
+    self.buffer = None
+
+    if path.endswith('.h5'):
+      import h5py
+
+      self.file = h5py.File(path, 'r')
+      self.chunks = self.read_hdf5()
+    else:
+      import pandas as pd
+
+      self.file = None
+      self.chunks = (
+        {name: chunk[name].to_numpy(np.int64) for name in METADATA_COLUMNS}
+        for chunk in pd.read_csv(path, usecols=METADATA_COLUMNS, chunksize=chunk_rows)
+      )
+
+  def read_hdf5(self):
+    total = len(self.file['CounterValue'])
+    for start in range(0, total, self.chunk_rows):
+      yield {name: self.file[name][start:start + self.chunk_rows].astype(np.int64) for name in METADATA_COLUMNS}
+
+  def read(self, rows=None):
+    """Return the next chunk (at most rows rows when given), or None once the segment is exhausted."""
+    if self.buffer is None:
+      self.buffer = next(self.chunks, None)
+      if self.buffer is None:
+        return None
+
+    if rows is None or rows >= len(self.buffer['CounterValue']):
+      chunk, self.buffer = self.buffer, None
+      return chunk
+
+    chunk = {name: values[:rows] for name, values in self.buffer.items()}
+    self.buffer = {name: values[rows:] for name, values in self.buffer.items()}
+    return chunk
+
+  def available(self):
+    """Rows that can be read without going back to the file, loading the next chunk if needed."""
+    if self.buffer is None:
+      self.buffer = next(self.chunks, None)
+
+    return 0 if self.buffer is None else len(self.buffer['CounterValue'])
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+
+
+class Histogram:
+  def __init__(self, bin_width, maximum):
+    self.bin_width = bin_width
+    self.counts = np.zeros(maximum // bin_width + 1, dtype=np.int64)
+    self.total = 0
+    self.sum = 0.0
+    self.sum_squares = 0.0
+    self.minimum = np.inf
+    self.maximum = -np.inf
+
+  def add(self, values):
+    if not len(values):
+      return
+
+    # Everything beyond the last bin is counted in the last bin
+    bins = np.minimum((values // self.bin_width).astype(np.int64), len(self.counts) - 1)
+    self.counts += np.bincount(np.maximum(bins, 0), minlength=len(self.counts))
+    self.total += len(values)
+    self.sum += float(values.sum())
+    self.sum_squares += float(np.square(values, dtype=np.float64).sum())
+    self.minimum = min(self.minimum, float(values.min()))
+    self.maximum = max(self.maximum, float(values.max()))
+
+  def percentile(self, q):
+    # Lower edge of the bin holding the q-th percentile, so only accurate to one bin width
+    cumulative = np.cumsum(self.counts)
+    return float(np.searchsorted(cumulative, q / 100 * self.total) * self.bin_width)
+
+  def summary(self):
+    if not self.total:
+      return None
+
+    mean = self.sum / self.total
+    return {
+      'count': self.total,
+      'mean': mean,
+      'std': max(self.sum_squares / self.total - mean ** 2, 0.0) ** 0.5,
+      'min': self.minimum,
+      'p1': self.percentile(1),
+      'p50': self.percentile(50),
+      'p99': self.percentile(99),
+      'max': self.maximum
+    }
+
+
+class CameraTiming:
+  """Per-camera accumulators for frame intervals, counter gaps and I/O line activity."""
+
+  def __init__(self):
+    self.frames = 0
+    self.intervals = Histogram(IFI_BIN_US, IFI_MAX_US)
+    self.counter_gaps = 0
+    self.missing_frames = 0
+    self.counter_resets = 0
+    self.high_frames = np.zeros(NUM_LINES, dtype=np.int64)
+    self.rising_edges = np.zeros(NUM_LINES, dtype=np.int64)
+    self.falling_edges = np.zeros(NUM_LINES, dtype=np.int64)
+    self.high_periods = [Histogram(1, 10_000) for _ in range(NUM_LINES)]
+    self.reset()
+
+  def finish(self):
+    # Called at the end of every segment; a line that's still high ends its run there
+    for line in range(NUM_LINES):
+      if self.run_lengths[line]:
+        self.high_periods[line].add(self.run_lengths[line:line + 1])
+    self.reset()
+
+  def reset(self):
+    # Called at every segment boundary
+    self.last_timestamp = None
+    self.last_counter = None
+    self.last_bits = None
+    self.run_lengths = np.zeros(NUM_LINES, dtype=np.int64)
+
+  def add(self, chunk):
+    timestamps = chunk['Timestamp_ns']
+    counters = chunk['CounterValue']
+    if not len(timestamps):
+      return
+
+    self.frames += len(timestamps)
+
+    if self.last_timestamp is not None:
+      timestamps = np.concatenate([[self.last_timestamp], timestamps])
+      counters = np.concatenate([[self.last_counter], counters])
+
+    self.intervals.add(np.diff(timestamps) / 1000)
+
+    counter_steps = np.diff(counters)
+    gaps = counter_steps > 1
+    self.counter_gaps += int(gaps.sum())
+    self.missing_frames += int((counter_steps[gaps] - 1).sum())
+    self.counter_resets += int((counter_steps <= 0).sum())
+
+    # Bits of LineStatusAll as a (frames, lines) array
+    chunk_bits = (chunk['LineStatusAll'][:, None] >> np.arange(NUM_LINES)) & 1
+    self.high_frames += chunk_bits.sum(axis=0)
+
+    bits = chunk_bits if self.last_bits is None else np.concatenate([self.last_bits[None], chunk_bits])
+    edges = np.diff(bits.astype(np.int8), axis=0)
+    self.rising_edges += (edges == 1).sum(axis=0)
+    self.falling_edges += (edges == -1).sum(axis=0)
+
+    for line in range(NUM_LINES):
+      self.add_high_periods(line, chunk_bits[:, line])
+
+    self.last_timestamp = int(timestamps[-1])
+    self.last_counter = int(counters[-1])
+    self.last_bits = chunk_bits[-1]
+
+  def add_high_periods(self, line, bits):
+    # Lengths (in frames) of the runs where the line was high. A run touching the end of the chunk is carried over into
+    # the next one, and counted once it ends there (or the segment does, see finish())
+    changes = np.flatnonzero(np.diff(bits)) + 1
+    starts = np.concatenate([[0], changes])
+    ends = np.concatenate([changes, [len(bits)]])
+    high = bits[starts] == 1
+
+    lengths = (ends - starts)[high]
+    carried = self.run_lengths[line]
+    if carried:
+      if len(lengths) and starts[high][0] == 0:
+        lengths[0] += carried
+      else:
+        # The carried run ended right at the chunk boundary
+        lengths = np.concatenate([[carried], lengths])
+
+    if high.any() and ends[high][-1] == len(bits):
+      self.run_lengths[line] = lengths[-1]
+      lengths = lengths[:-1]
+    else:
+      self.run_lengths[line] = 0
+
+    self.high_periods[line].add(lengths)
+
+  def summary(self):
+    return {
+      'frames': self.frames,
+      'inter_frame_interval_us': self.intervals.summary(),
+      'counter_gaps': self.counter_gaps,
+      'missing_frames': self.missing_frames,
+      'counter_resets': self.counter_resets,
+      'lines': {
+        f'Line{line}': {
+          'high_fraction': float(self.high_frames[line] / self.frames) if self.frames else None,
+          'rising_edges': int(self.rising_edges[line]),
+          'falling_edges': int(self.falling_edges[line]),
+          'high_period_frames': self.high_periods[line].summary()
+        }
+        for line in range(NUM_LINES)
+      }
+    }
+
+
+class Session:
+  """Runs the accumulators over every segment of a session and produces the report."""
+
+  def __init__(self, trigger_line=3, chunk_rows=CHUNK_ROWS):
+    self.trigger_line = trigger_line
+    self.chunk_rows = chunk_rows
+    self.segments = 0
+    self.cameras = {}
+    self.skews = {}
+    self.mismatched_segments = []
+
+  def add_segment(self, segment, paths):
+    """paths maps camera name -> metadata log for one segment. Cameras are read in lockstep, row by row, because every
+    camera sees the same triggers; the skew is how far each camera's time since the segment start drifts from the first
+    camera's (the camera clocks aren't synchronized, so absolute timestamps can't be compared)."""
+    self.segments += 1
+    readers = {camera: ChunkReader(path, self.chunk_rows) for camera, path in paths.items()}
+    reference = min(readers)
+    origins = {}
+
+    try:
+      for camera in readers:
+        self.cameras.setdefault(camera, CameraTiming()).reset()
+
+      while True:
+        rows = min(reader.available() for reader in readers.values())
+        if not rows:
+          break
+
+        chunks = {camera: reader.read(rows) for camera, reader in readers.items()}
+        for camera, chunk in chunks.items():
+          self.cameras[camera].add(chunk)
+          origins.setdefault(camera, int(chunk['Timestamp_ns'][0]))
+
+        reference_elapsed = chunks[reference]['Timestamp_ns'] - origins[reference]
+        for camera, chunk in chunks.items():
+          if camera != reference:
+            elapsed = chunk['Timestamp_ns'] - origins[camera]
+            self.skews.setdefault(camera, Histogram(SKEW_BIN_US, SKEW_MAX_US)).add(
+              np.abs(elapsed - reference_elapsed) / 1000
+            )
+
+      # Whatever is left over belongs to cameras that recorded more frames than the others
+      leftovers = {camera: 0 for camera in readers}
+      for camera, reader in readers.items():
+        while (chunk := reader.read()) is not None:
+          self.cameras[camera].add(chunk)
+          leftovers[camera] += len(chunk['CounterValue'])
+
+      for camera in readers:
+        self.cameras[camera].finish()
+
+      if any(leftovers.values()):
+        self.mismatched_segments.append({'segment': segment, 'extra_frames': leftovers})
+    finally:
+      for reader in readers.values():
+        reader.close()
+
+  def report(self):
+    reference = min(self.cameras) if self.cameras else None
+    return {
+      'segments': self.segments,
+      'trigger_line': f'Line{self.trigger_line}',
+      'cameras': {camera: timing.summary() for camera, timing in sorted(self.cameras.items())},
+      # Frames whose FrameStart found the trigger line low weren't started by the trigger we think they were
+      'frames_with_trigger_low': {
+        camera: int(timing.frames - timing.high_frames[self.trigger_line])
+        for camera, timing in sorted(self.cameras.items())
+      },
+      'skew_reference': reference,
+      'skew_us': {camera: skew.summary() for camera, skew in sorted(self.skews.items())},
+      'frame_count_mismatches': self.mismatched_segments
+    }
+
+  def plot(self, directory):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    figure, axes = plt.subplots(1, 3, figsize=(18, 5))
+
+    for camera, timing in sorted(self.cameras.items()):
+      counts = timing.intervals.counts
+      populated = np.flatnonzero(counts)
+      if len(populated):
+        bins = np.arange(populated[0], populated[-1] + 1)
+        axes[0].step(bins * IFI_BIN_US / 1000, counts[bins], where='post', label=camera)
+    axes[0].set_xlabel('Inter-frame interval [ms]')
+    axes[0].set_ylabel('Frames')
+    axes[0].set_yscale('log')
+    axes[0].legend()
+
+    for camera, skew in sorted(self.skews.items()):
+      populated = np.flatnonzero(skew.counts)
+      if len(populated):
+        bins = np.arange(populated[-1] + 1)
+        axes[1].step(bins * SKEW_BIN_US, skew.counts[bins], where='post', label=camera)
+    axes[1].set_xlabel(f'Skew relative to {min(self.cameras)} [us]')
+    axes[1].set_ylabel('Frames')
+    axes[1].set_yscale('log')
+    axes[1].legend()
+
+    cameras = sorted(self.cameras)
+    width = 0.8 / max(len(cameras), 1)
+    for i, camera in enumerate(cameras):
+      timing = self.cameras[camera]
+      fraction = timing.high_frames / max(timing.frames, 1)
+      axes[2].bar(np.arange(NUM_LINES) + i * width, fraction, width, label=camera)
+    axes[2].set_xlabel('IO line')
+    axes[2].set_ylabel('Fraction of frames high')
+    axes[2].set_xticks(np.arange(NUM_LINES) + 0.4 - width / 2)
+    axes[2].set_xticklabels([str(line) for line in range(NUM_LINES)])
+    axes[2].legend()
+
+    figure.tight_layout()
+    path = os.path.join(directory, 'timing_qc.png')
+    figure.savefig(path)
+    plt.close(figure)
+    return path
+
+
+def segments_from_catalog(path, **filters):
+  from session_catalog import SessionCatalog
+
+  catalog = SessionCatalog(path)
+  try:
+    segments = {}
+    for row in catalog.query(**filters):
+      if row['metadata_path']:
+        segments.setdefault(row['segment'], {})[row['camera']] = row['metadata_path']
+    return segments
+  finally:
+    catalog.close()
+
+
+def segments_from_directories(directories):
+  segments = {}
+  for directory in directories:
+    for path in glob.glob(os.path.join(directory, '**', '*'), recursive=True):
+      name = os.path.basename(path)
+      match = METADATA_PATTERN.match(name)
+      if match:
+        segments.setdefault(match.group('segment'), {})[match.group('camera') or 'camA'] = path
+      elif name.endswith('.h5'):
+        camera, _, segment = name[:-3].partition('_')
+        segments.setdefault(segment, {})[camera] = path
+  return segments
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Frame timing and trigger QC for a recording session')
+  parser.add_argument('source', nargs='+', help='A catalog database, or directories containing metadata logs')
+  parser.add_argument('--output', required=True, help='Directory for the report and plots')
+  parser.add_argument('--after', help='Only segments started at or after this time (catalog only)')
+  parser.add_argument('--before', help='Only segments started before this time (catalog only)')
+  parser.add_argument('--trigger-line', type=int, default=3)
+  parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+  parser.add_argument('--plots', action='store_true', help='Also save summary plots (needs matplotlib)')
+  args = parser.parse_args()
+
+  if len(args.source) == 1 and os.path.isfile(args.source[0]):
+    segments = segments_from_catalog(args.source[0], after=args.after, before=args.before)
+  else:
+    segments = segments_from_directories(args.source)
+
+  session = Session(args.trigger_line, args.chunk_rows)
+  for segment, paths in sorted(segments.items()):
+    session.add_segment(segment, paths)
+
+  os.makedirs(args.output, exist_ok=True)
+  report_path = os.path.join(args.output, 'timing_qc.json')
+  with open(report_path, 'w') as f:
+    json.dump(session.report(), f, indent=2)
+  print(f'Wrote {report_path}')
+
+  if args.plots:
+    print(f'Wrote {session.plot(args.output)}')
+
+
+if __name__ == '__main__':
+  main()